@@ -1 +1 @@
-python app/main.py
+gunicorn -c gunicorn.conf.py app.main:app
\ No newline at end of file
@@ -1,32 +1,272 @@
 import os
 import logging
 import smtplib
+import ssl
 import json
 import base64
+import bisect
+import click
 import csv
-from datetime import datetime
+import atexit
+import fcntl
+import functools
+import glob
+import hashlib
+import hmac
+import io
+import mimetypes
+import queue
+import random
+import re
+import string
+import sqlite3
+import threading
+import time
+import zlib
+
+# Cold-start timing: module import starts here; see startup_timings below
+APP_IMPORT_STARTED = time.monotonic()
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+import email.utils
+from flask import Flask, render_template, request, jsonify, redirect, url_for, Response, stream_with_context, g, send_from_directory
 from urllib.parse import urlparse
-import stripe
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+from werkzeug.utils import safe_join
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import brotli
+except ImportError:  # Installed from requirements.txt; a bare local install serves gzip only
+    brotli = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
 
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
-# Verify Stripe key is loaded
-if not stripe.api_key:
-    logger.error("STRIPE_SECRET_KEY environment variable not found!")
-else:
-    logger.info("Stripe API key loaded successfully")
+# Prometheus-style metrics: fixed-bucket histograms and counters in process memory, rendered by /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CHECKOUT_BUCKETS = (5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+METRICS = {
+    'pos_http_request_duration_seconds': ('histogram', 'Time to response headers by route', LATENCY_BUCKETS),
+    'pos_stripe_request_duration_seconds': ('histogram', 'Stripe API call latency including retries', LATENCY_BUCKETS),
+    'pos_stripe_request_errors_total': ('counter', 'Stripe API calls that ended in an error', None),
+    'pos_email_send_duration_seconds': ('histogram', 'Email send latency', LATENCY_BUCKETS),
+    'pos_email_send_failures_total': ('counter', 'Email sends that failed', None),
+    'pos_transaction_log_write_duration_seconds': ('histogram', 'Time to write one batch of transaction rows', LATENCY_BUCKETS),
+    'pos_transaction_log_dropped_rows_total': ('counter', 'Transaction rows dropped after repeated write failures', None),
+    'pos_checkout_duration_seconds': ('histogram', 'Time from PaymentIntent creation to success', CHECKOUT_BUCKETS),
+}
+_metric_series = {}  # (name, labels) -> counter value or {'buckets', 'sum', 'count'}
+_metrics_lock = threading.Lock()
+
+def observe_metric(name, value, **labels):
+    """Add one observation to a histogram"""
+    buckets = METRICS[name][2]
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        series = _metric_series.get(key)
+        if series is None:
+            series = _metric_series[key] = {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+        series['buckets'][bisect.bisect_left(buckets, value)] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+def increment_metric(name, amount=1, **labels):
+    """Add to a counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _metric_series[key] = _metric_series.get(key, 0) + amount
+
+def format_metric_labels(labels):
+    """Render label pairs as {key="value",...}, escaped for the text exposition format"""
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def render_metrics(sampled):
+    """Render recorded metrics plus sampled (name, type, help, [(labels, value)]) ones as Prometheus text"""
+    with _metrics_lock:
+        snapshot = {key: dict(series, buckets=list(series['buckets'])) if isinstance(series, dict) else series
+                    for key, series in _metric_series.items()}
+    
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (series_name, labels), series in sorted(snapshot.items()):
+            if series_name != name:
+                continue
+            if kind == 'counter':
+                lines.append(f"{name}{format_metric_labels(labels)} {series}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), series['buckets']):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {series['sum']:.6f}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {series['count']}")
+    
+    for name, kind, help_text, samples in sampled:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{format_metric_labels(tuple(sorted(labels.items())))} {value}")
+    return '\n'.join(lines) + '\n'
+
+# Cold-start phases in seconds (module import, Stripe SDK import, first /health), exported by /metrics
+startup_timings = {}
+
+# Stripe HTTP transport: one keep-alive pool shared by all threads, bounded timeouts, automatic retries
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', '2'))
+STRIPE_CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT', '5'))
+STRIPE_READ_TIMEOUT = float(os.getenv('STRIPE_READ_TIMEOUT', '30'))
+STRIPE_POOL_SIZE = int(os.getenv('STRIPE_POOL_SIZE', '16'))
+
+# Friendly names for the Stripe endpoints the app calls, used to label latency stats
+STRIPE_OPERATIONS = [
+    ('post', re.compile(r'^/v1/payment_intents$'), 'PaymentIntent.create'),
+    ('get', re.compile(r'^/v1/payment_intents$'), 'PaymentIntent.list'),
+    ('get', re.compile(r'^/v1/payment_intents/[^/]+$'), 'PaymentIntent.retrieve'),
+    ('post', re.compile(r'^/v1/payment_intents/[^/]+$'), 'PaymentIntent.modify'),
+    ('post', re.compile(r'^/v1/payment_intents/[^/]+/cancel$'), 'PaymentIntent.cancel'),
+    ('get', re.compile(r'^/v1/terminal/readers$'), 'Reader.list'),
+    ('post', re.compile(r'^/v1/terminal/readers$'), 'Reader.create'),
+    ('post', re.compile(r'^/v1/terminal/readers/[^/]+/process_payment_intent$'), 'Reader.process_payment_intent'),
+    ('post', re.compile(r'^/v1/terminal/connection_tokens$'), 'ConnectionToken.create'),
+]
+
+stripe_call_stats = {}  # operation -> {'count', 'errors', 'total_seconds', 'max_seconds'}
+stripe_call_stats_lock = threading.Lock()
+
+def stripe_operation_name(method, url):
+    """Label a Stripe request as e.g. PaymentIntent.create, falling back to 'METHOD /path/{id}'"""
+    path = urlparse(url).path
+    for op_method, pattern, name in STRIPE_OPERATIONS:
+        if method.lower() == op_method and pattern.match(path):
+            return name
+    return f"{method.upper()} {re.sub(r'/[a-z]+_[A-Za-z0-9_]+', '/{id}', path)}"
+
+def record_stripe_call(operation, seconds, failed):
+    """Add one Stripe call (including its retries) to the latency stats"""
+    with stripe_call_stats_lock:
+        stats = stripe_call_stats.setdefault(operation, {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        stats['count'] += 1
+        stats['errors'] += int(failed)
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+    observe_metric('pos_stripe_request_duration_seconds', seconds, operation=operation)
+    if failed:
+        increment_metric('pos_stripe_request_errors_total', operation=operation)
+
+def get_stripe_call_stats():
+    """Per-operation Stripe call counts, errors and latency"""
+    with stripe_call_stats_lock:
+        return {
+            operation: {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'avg_ms': round(stats['total_seconds'] / stats['count'] * 1000, 1),
+                'max_ms': round(stats['max_seconds'] * 1000, 1),
+            }
+            for operation, stats in stripe_call_stats.items()
+        }
+
+def build_stripe_http_client(sdk):
+    """Stripe's requests client on a shared connection pool, timing each call and also retrying 429s"""
+    
+    class PooledStripeClient(sdk.RequestsClient):
+        def request_with_retries(self, method, url, headers, post_data=None, max_network_retries=None, **kwargs):
+            started = time.monotonic()
+            failed = True
+            try:
+                response = super().request_with_retries(method, url, headers, post_data, max_network_retries, **kwargs)
+                failed = response[1] >= 400
+                return response
+            finally:
+                record_stripe_call(stripe_operation_name(method, url), time.monotonic() - started, failed)
+        
+        def _should_retry(self, response, api_connection_error, num_retries, max_network_retries):
+            # Rate limits are safe to retry: POSTs always carry an idempotency key, so a replay can't double-charge
+            if response is not None and response[1] == 429 and num_retries < (max_network_retries or 0):
+                return response[2].get('stripe-should-retry') != 'false'
+            return super()._should_retry(response, api_connection_error, num_retries, max_network_retries)
+    
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=STRIPE_POOL_SIZE))
+    return PooledStripeClient(timeout=(STRIPE_CONNECT_TIMEOUT, STRIPE_READ_TIMEOUT), session=session)
+
+# The Stripe SDK is the slowest import in the app, so it isn't on the path to the first /health:
+# load_stripe() imports it in the background after startup, and before any request or command that needs it
+stripe = None
+_stripe_load_lock = threading.Lock()
+
+def load_stripe():
+    """Import and configure the Stripe SDK once per process; returns the module"""
+    global stripe
+    if stripe is not None:
+        return stripe
+    with _stripe_load_lock:
+        if stripe is None:
+            started = time.monotonic()
+            import stripe as sdk
+            startup_timings['import_stripe'] = time.monotonic() - started
+            
+            sdk.api_key = os.getenv('STRIPE_SECRET_KEY')
+            # Verify Stripe key is loaded
+            if not sdk.api_key:
+                logger.error("STRIPE_SECRET_KEY environment variable not found!")
+            else:
+                logger.info("Stripe API key loaded successfully")
+            # Point the Stripe client at a local stand-in such as stripe-mock (e.g. http://localhost:12111)
+            if os.getenv('STRIPE_API_BASE'):
+                sdk.api_base = os.getenv('STRIPE_API_BASE')
+                logger.info(f"Using Stripe API base {sdk.api_base}")
+            sdk.default_http_client = build_stripe_http_client(sdk)
+            # Retried POSTs reuse the request's idempotency key, which the library adds automatically
+            sdk.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+            # Publish the module only once it is fully configured
+            stripe = sdk
+    return stripe
+
+def preload_stripe():
+    """Load the Stripe SDK on a background thread so the first checkout doesn't wait for it"""
+    if stripe is None:
+        threading.Thread(target=load_stripe, name='stripe-import', daemon=True).start()
+
 STRIPE_LOCATION_ID = os.getenv('STRIPE_LOCATION_ID')
+# Signing secret for the /stripe-webhook endpoint (whsec_...)
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+# Seconds a stored payment state is trusted before payment_status asks Stripe again
+PAYMENT_STATE_MAX_AGE = int(os.getenv('PAYMENT_STATE_MAX_AGE', '30'))
+# Webhooks count as active while verified events keep arriving; a configured secret alone proves nothing
+WEBHOOK_ACTIVE_WINDOW = 600  # Seconds after the last verified webhook that stored state is trusted
+_last_webhook_at = None  # time.monotonic() of the last verified webhook
+# Seconds a status stream or long-poll waits for a state change before re-checking;
+# without webhooks changes only arrive by asking Stripe, so re-check as often as the old 2s poll
+PAYMENT_STREAM_CHECK_INTERVAL_WEBHOOKS = 15
+PAYMENT_STREAM_CHECK_INTERVAL_POLLING = 2
+PAYMENT_STREAM_MAX_SECONDS = 120  # Streams end after this long; EventSource reconnects on its own
+PAYMENT_LONG_POLL_MAX_SECONDS = 30
+# Seconds a retrieved in-progress PaymentIntent is reused; settled ones are cached until evicted
+PAYMENT_INTENT_CACHE_TTL = float(os.getenv('PAYMENT_INTENT_CACHE_TTL', '1.5'))
+PAYMENT_INTENT_CACHE_SIZE = 500
+# Seconds the cached reader list is used before listing readers from Stripe again
+READER_CACHE_TTL = int(os.getenv('READER_CACHE_TTL', '60'))
+# Seconds a reader stays reserved for a payment that never reports a result
+READER_LEASE_SECONDS = int(os.getenv('READER_LEASE_SECONDS', '180'))
+# Seconds a queued checkout keeps its place in line without re-polling
+READER_QUEUE_TIMEOUT = int(os.getenv('READER_QUEUE_TIMEOUT', '15'))
 # Membership amounts in cents
 INDIVIDUAL_MEMBERSHIP_AMOUNT = int(os.getenv('INDIVIDUAL_MEMBERSHIP_AMOUNT', '3500'))  # $35 in cents
 HOUSEHOLD_MEMBERSHIP_AMOUNT = int(os.getenv('HOUSEHOLD_MEMBERSHIP_AMOUNT', '5000'))  # $50 in cents
@@ -34,10 +274,33 @@ HOUSEHOLD_MEMBERSHIP_AMOUNT = int(os.getenv('HOUSEHOLD_MEMBERSHIP_AMOUNT', '5000
 # Raffle configuration
 RAFFLE_ENABLED = os.getenv('RAFFLE_ENABLED', 'false').lower() == 'true'
 RAFFLE_PRICE_PER_TICKET = 80  # 80 cents per ticket
+RAFFLE_PACKAGES = ((5, 500), (12, 1000), (25, 2000))  # (tickets, cents) packages offered on the checkout page
+RAFFLE_CUSTOM_MIN_TICKETS = 26  # Quantities that aren't a package are sold per ticket from this many up
+
+def raffle_price(quantity):
+    """Price in cents for a raffle quantity: its package price, else per ticket; raises ValueError"""
+    packages = dict(RAFFLE_PACKAGES)
+    if quantity in packages:
+        return packages[quantity]
+    if quantity < RAFFLE_CUSTOM_MIN_TICKETS:
+        raise ValueError(f'Custom raffle quantities must be {RAFFLE_CUSTOM_MIN_TICKETS} or more tickets')
+    return quantity * RAFFLE_PRICE_PER_TICKET
+
+# Pre-created PaymentIntents for fixed-price checkouts; 0 disables the pool
+PAYMENT_INTENT_POOL_SIZE = int(os.getenv('PAYMENT_INTENT_POOL_SIZE', '0'))  # Ready intents per amount
+PAYMENT_INTENT_POOL_MAX_AGE = int(os.getenv('PAYMENT_INTENT_POOL_MAX_AGE', '3600'))  # Seconds before an unused one is replaced
+PAYMENT_INTENT_POOL_REFILL_INTERVAL = 30  # Seconds between expiry checks when no checkout wakes the refiller
 
-# Email configuration
+# Email configuration: MAIL_TRANSPORT is 'gmail' (Gmail API with OAuth2) or 'smtp' (pooled SMTP sessions)
+MAIL_TRANSPORT = os.getenv('MAIL_TRANSPORT', 'gmail').lower()
 SMTP_SERVER = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
 SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_USERNAME = os.getenv('SMTP_USERNAME')  # No login when unset, e.g. a local relay or test sink
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', 'true').lower() == 'true'  # false only for local sinks such as aiosmtpd
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '30'))  # Socket timeout in seconds
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '4'))  # Idle sessions kept open for reuse
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', '60'))  # Seconds before an idle session is replaced rather than reused
 FROM_EMAIL = os.getenv('FROM_EMAIL')
 NOTIFICATION_EMAIL = os.getenv('NOTIFICATION_EMAIL')
 ORGANIZATION_NAME = os.getenv('ORGANIZATION_NAME', 'Community Organization')
@@ -53,11 +316,106 @@ GOOGLE_REFRESH_TOKEN = os.getenv('GOOGLE_REFRESH_TOKEN')
 
 # Gmail API scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+# Refresh the cached access token once it is this close to expiry
+GMAIL_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
 
 # Transaction logging directory
-LOG_DIR = os.getenv('LOG_DIR', '/app/logs')
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
+LOG_DIR = os.getenv('LOG_DIR', '/app/logs')  # Created on first write, see ensure_dir()
+
+# Transaction ledger: 'csv' writes monthly transactions_YYYY-MM.csv files, 'sqlite' an indexed table
+TRANSACTION_LOG_BACKEND = os.getenv('TRANSACTION_LOG_BACKEND', 'csv').lower()
+TRANSACTION_LOG_BATCH_WINDOW = 0.2  # Seconds the writer gathers rows before one write + fsync
+TRANSACTION_FIELDNAMES = [
+    'timestamp', 'payment_intent_id', 'payer_name', 'payer_email', 
+    'amount_cents', 'amount_dollars', 'payment_type', 'status',
+    'cover_fees', 'base_amount', 'fee_amount'
+]
+
+# Token required by admin data endpoints (exports, reports); they are disabled when unset
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN')
+
+# SQLite database for durable app state (email outbox, side-effect ledger)
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(LOG_DIR, 'pos_state.db'))
+
+# Email outbox configuration
+EMAIL_WORKERS = int(os.getenv('EMAIL_WORKERS', '2'))
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '6'))
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv('EMAIL_RETRY_BASE_SECONDS', '10'))
+EMAIL_RETRY_MAX_SECONDS = float(os.getenv('EMAIL_RETRY_MAX_SECONDS', '900'))
+EMAIL_OUTBOX_POLL_INTERVAL = 5  # Seconds between outbox scans when idle
+EMAIL_SEND_TIMEOUT = 300  # Seconds before a job stuck in 'sending' is retried
+
+@functools.cache
+def ensure_dir(path):
+    """Create a data directory the first time something is written there, not at import"""
+    os.makedirs(path, exist_ok=True)
+    return path
+
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_initialized = False
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    claimed_at REAL,
+    sent_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    payment_intent_id TEXT NOT NULL,
+    payer_name TEXT,
+    payer_email TEXT,
+    amount_cents INTEGER,
+    amount_dollars TEXT,
+    payment_type TEXT,
+    status TEXT,
+    cover_fees TEXT,
+    base_amount TEXT,
+    fee_amount TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_payment_intent ON transactions (payment_intent_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_timestamp ON transactions (timestamp);
+CREATE TABLE IF NOT EXISTS report_files (
+    filename TEXT PRIMARY KEY,
+    byte_offset INTEGER NOT NULL,
+    header TEXT,
+    aggregates TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS payment_side_effects (
+    payment_intent_id TEXT NOT NULL,
+    effect TEXT NOT NULL,
+    claimed_at REAL NOT NULL,
+    PRIMARY KEY (payment_intent_id, effect)
+);
+"""
+
+def get_db():
+    """Return this thread's connection to the state database (WAL mode, autocommit)"""
+    global _db_initialized
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        ensure_dir(os.path.dirname(os.path.abspath(STATE_DB_PATH)))
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with _db_init_lock:
+            if not _db_initialized:
+                conn.executescript(STATE_DB_SCHEMA)
+                _db_initialized = True
+        _db_local.conn = conn
+    return conn
 
 def check_domain_redirect():
     """Check if request should be redirected to primary domain"""
@@ -84,49 +442,875 @@ def check_domain_redirect():
     
     return None
 
+def require_admin_token(view):
+    """Protect an admin data endpoint with ADMIN_API_TOKEN (Bearer header or ?token=)"""
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        if not ADMIN_API_TOKEN:
+            return jsonify({'error': 'ADMIN_API_TOKEN not configured'}), 403
+        
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header[7:] if auth_header.startswith('Bearer ') else request.args.get('token', '')
+        if not hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode()):
+            return jsonify({'error': 'Invalid admin token'}), 403
+        return view(*args, **kwargs)
+    return wrapped
+
+def transaction_log_path(month):
+    """Monthly CSV ledger file for a YYYY-MM month"""
+    return os.path.join(LOG_DIR, f"transactions_{month}.csv")
+
+# Ledger writer: log_transaction only enqueues; one appender thread batches writes per fsync
+_transaction_queue = queue.Queue()
+_transaction_writer_lock = threading.Lock()
+_transaction_writer = None
+
 def log_transaction(payment_intent_id, payer_name, payer_email, amount, payment_type, status, metadata=None):
-    """Log transaction details (no sensitive payment info)"""
+    """Queue transaction details for the ledger writer (no sensitive payment info)"""
     try:
-        log_file = os.path.join(LOG_DIR, f"transactions_{datetime.now().strftime('%Y-%m')}.csv")
-        
-        # Create CSV headers if file doesn't exist
-        file_exists = os.path.isfile(log_file)
+        # Extract metadata
+        cover_fees = metadata.get('cover_fees', 'false') if metadata else 'false'
+        base_amount = metadata.get('base_amount', str(amount)) if metadata else str(amount)
+        fee_amount = metadata.get('fee_amount', '0') if metadata else '0'
+        
+        start_transaction_writer()
+        _transaction_queue.put({
+            'timestamp': datetime.now().isoformat(),
+            'payment_intent_id': payment_intent_id,
+            'payer_name': payer_name,
+            'payer_email': payer_email or '',
+            'amount_cents': amount,
+            'amount_dollars': f"{amount/100:.2f}",
+            'payment_type': payment_type,
+            'status': status,
+            'cover_fees': cover_fees,
+            'base_amount': base_amount,
+            'fee_amount': fee_amount
+        })
         
-        with open(log_file, 'a', newline='', encoding='utf-8') as csvfile:
-            fieldnames = [
-                'timestamp', 'payment_intent_id', 'payer_name', 'payer_email', 
-                'amount_cents', 'amount_dollars', 'payment_type', 'status',
-                'cover_fees', 'base_amount', 'fee_amount'
-            ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            
-            if not file_exists:
-                writer.writeheader()
-            
-            # Extract metadata
-            cover_fees = metadata.get('cover_fees', 'false') if metadata else 'false'
-            base_amount = metadata.get('base_amount', str(amount)) if metadata else str(amount)
-            fee_amount = metadata.get('fee_amount', '0') if metadata else '0'
-            
-            writer.writerow({
-                'timestamp': datetime.now().isoformat(),
-                'payment_intent_id': payment_intent_id,
-                'payer_name': payer_name,
-                'payer_email': payer_email or '',
-                'amount_cents': amount,
-                'amount_dollars': f"{amount/100:.2f}",
-                'payment_type': payment_type,
-                'status': status,
-                'cover_fees': cover_fees,
-                'base_amount': base_amount,
-                'fee_amount': fee_amount
-            })
-            
         logger.info(f"Transaction logged: {payment_intent_id} - ${amount/100:.2f}")
         
     except Exception as e:
         logger.error(f"Error logging transaction: {str(e)}")
 
+def start_transaction_writer():
+    """Start the ledger appender thread once per process"""
+    global _transaction_writer
+    if _transaction_writer:
+        return
+    with _transaction_writer_lock:
+        if _transaction_writer:
+            return
+        _transaction_writer = threading.Thread(target=transaction_writer, name='transaction-writer', daemon=True)
+        _transaction_writer.start()
+        atexit.register(flush_transaction_log)
+
+def write_transaction_rows_csv(rows):
+    """Append rows to their monthly CSV files, one locked write and fsync per file"""
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row['timestamp'][:7], []).append(row)
+    
+    ensure_dir(LOG_DIR)
+    for month, month_rows in by_month.items():
+        with open(transaction_log_path(month), 'a', newline='', encoding='utf-8') as csvfile:
+            # The file lock keeps rows and the header from interleaving across gunicorn workers
+            fcntl.flock(csvfile, fcntl.LOCK_EX)
+            try:
+                csvfile.seek(0, os.SEEK_END)
+                writer = csv.DictWriter(csvfile, fieldnames=TRANSACTION_FIELDNAMES)
+                if csvfile.tell() == 0:
+                    writer.writeheader()
+                writer.writerows(month_rows)
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+            finally:
+                fcntl.flock(csvfile, fcntl.LOCK_UN)
+
+def write_transaction_rows_sqlite(rows):
+    """Insert rows into the transactions table in one transaction"""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(
+            f"INSERT INTO transactions ({', '.join(TRANSACTION_FIELDNAMES)}) VALUES ({', '.join('?' * len(TRANSACTION_FIELDNAMES))})",
+            [[row[field] for field in TRANSACTION_FIELDNAMES] for row in rows]
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def transaction_writer():
+    """Group-commit queued transaction rows until the process exits"""
+    while True:
+        batch = [_transaction_queue.get()]
+        time.sleep(TRANSACTION_LOG_BATCH_WINDOW)
+        while True:
+            try:
+                batch.append(_transaction_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        for attempt in range(3):
+            try:
+                started = time.monotonic()
+                if TRANSACTION_LOG_BACKEND == 'sqlite':
+                    write_transaction_rows_sqlite(batch)
+                else:
+                    write_transaction_rows_csv(batch)
+                observe_metric('pos_transaction_log_write_duration_seconds', time.monotonic() - started,
+                               backend=TRANSACTION_LOG_BACKEND)
+                break
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} transaction rows (attempt {attempt + 1}): {str(e)}")
+                time.sleep(1)
+        else:
+            logger.error(f"Dropped transaction rows for: {', '.join(row['payment_intent_id'] for row in batch)}")
+            increment_metric('pos_transaction_log_dropped_rows_total', len(batch))
+        
+        for _ in batch:
+            _transaction_queue.task_done()
+
+def flush_transaction_log(timeout=5):
+    """Wait for queued transaction rows to reach disk; registered to run at exit"""
+    deadline = time.monotonic() + timeout
+    while _transaction_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+def iter_transaction_rows(start=None, end=None, statuses=None):
+    """Yield ledger rows dated within [start, end] (YYYY-MM-DD, inclusive) one at a time, oldest first"""
+    flush_transaction_log()
+    if TRANSACTION_LOG_BACKEND == 'sqlite':
+        cursor = get_db().execute(
+            f"SELECT {', '.join(TRANSACTION_FIELDNAMES)} FROM transactions WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+            (start or '', (end or '9999-12-31') + '~')
+        )
+        for row in cursor:
+            if not statuses or row['status'] in statuses:
+                yield dict(row)
+        return
+    
+    for path in sorted(glob.glob(os.path.join(LOG_DIR, 'transactions_*.csv'))):
+        month = os.path.basename(path)[len('transactions_'):-len('.csv')]
+        if (start and month < start[:7]) or (end and month > end[:7]):
+            continue
+        with open(path, newline='', encoding='utf-8') as csvfile:
+            for row in csv.DictReader(csvfile):
+                day = row['timestamp'][:10]
+                if (start and day < start) or (end and day > end):
+                    continue
+                if not statuses or row['status'] in statuses:
+                    yield row
+
+def stream_transaction_csv(rows, columns=TRANSACTION_FIELDNAMES, compress=False):
+    """Render rows as CSV in ~64KB chunks, gzipping on the fly if asked; memory stays constant"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31 writes a gzip container
+    
+    def take():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+    
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > 64 * 1024:
+            chunk = take()
+            if chunk:
+                yield chunk
+    yield take()
+    if compressor:
+        yield compressor.flush()
+
+# Reporting: per-day partial aggregates, kept per CSV file with the byte offset already scanned
+def empty_report_totals():
+    """Zeroed counters for one report bucket"""
+    return {'count': 0, 'amount_cents': 0, 'base_cents': 0, 'fee_cents': 0}
+
+def payment_category(payment_type):
+    """Bucket a payment_type into raffle, membership, donation or other"""
+    payment_type = (payment_type or '').lower()
+    for category in ('raffle', 'membership', 'donation'):
+        if category in payment_type:
+            return category
+    return 'other'
+
+def to_cents(value):
+    """Parse a logged cents value, treating blanks and junk as 0"""
+    try:
+        return int(float(value or 0))
+    except ValueError:
+        return 0
+
+def add_to_report(days, timestamp, payment_type, cover_fees, status, count, amount, base, fee):
+    """Fold one row (or a pre-grouped set of rows) into per-day aggregates"""
+    day = days.setdefault(timestamp[:10], {
+        'status': {}, 'total': empty_report_totals(), 'payment_type': {},
+        'category': {}, 'cover_fees': {}, 'hour': {}
+    })
+    day['status'][status] = day['status'].get(status, 0) + count
+    if status != 'succeeded':
+        return
+    
+    keys = {
+        'payment_type': payment_type or 'unknown',
+        'category': payment_category(payment_type),
+        'cover_fees': 'true' if str(cover_fees).lower() == 'true' else 'false',
+        'hour': timestamp[11:13] or '00',
+    }
+    for totals in [day['total']] + [day[dim].setdefault(key, empty_report_totals()) for dim, key in keys.items()]:
+        totals['count'] += count
+        totals['amount_cents'] += amount
+        totals['base_cents'] += base
+        totals['fee_cents'] += fee
+
+def update_report_file(conn, filename):
+    """Scan only the rows appended to a ledger CSV since the last report and return its day aggregates"""
+    path = os.path.join(LOG_DIR, filename)
+    size = os.path.getsize(path)
+    saved = conn.execute("SELECT * FROM report_files WHERE filename = ?", (filename,)).fetchone()
+    offset, header, days = (saved['byte_offset'], saved['header'], json.loads(saved['aggregates'])) if saved else (0, None, {})
+    
+    if size < offset:
+        # Truncated or replaced; start over
+        offset, header, days = 0, None, {}
+    if size == offset:
+        return days
+    
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        chunk = f.read(size - offset)
+    # Leave a partially written last line for the next run
+    consumed = chunk.rfind(b'\n') + 1
+    if consumed == 0:
+        return days
+    
+    lines = chunk[:consumed].decode('utf-8').splitlines()
+    if header is None:
+        header = lines.pop(0)
+    for row in csv.DictReader(lines, fieldnames=next(csv.reader([header]))):
+        add_to_report(
+            days, row['timestamp'], row['payment_type'], row['cover_fees'], row['status'], 1,
+            to_cents(row['amount_cents']), to_cents(row['base_amount']), to_cents(row['fee_amount'])
+        )
+    
+    conn.execute(
+        "INSERT OR REPLACE INTO report_files (filename, byte_offset, header, aggregates, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (filename, offset + consumed, header, json.dumps(days), time.time())
+    )
+    return days
+
+def collect_report_days(start, end):
+    """Per-day aggregates for days in [start, end] (YYYY-MM-DD strings, either may be None)"""
+    flush_transaction_log()
+    conn = get_db()
+    days = {}
+    
+    if TRANSACTION_LOG_BACKEND == 'sqlite':
+        # The timestamp index keeps this a range scan; grouping happens in SQLite
+        rows = conn.execute(
+            """SELECT substr(timestamp, 1, 13) AS hour_bucket, payment_type, cover_fees, status, COUNT(*) AS count,
+                      SUM(amount_cents) AS amount, SUM(CAST(base_amount AS INTEGER)) AS base,
+                      SUM(CAST(fee_amount AS INTEGER)) AS fee
+               FROM transactions WHERE timestamp >= ? AND timestamp < ?
+               GROUP BY hour_bucket, payment_type, cover_fees, status""",
+            (start or '', (end or '9999-12-31') + '~')
+        )
+        for row in rows:
+            add_to_report(days, row['hour_bucket'], row['payment_type'], row['cover_fees'], row['status'],
+                          row['count'], row['amount'] or 0, row['base'] or 0, row['fee'] or 0)
+        return days
+    
+    for path in sorted(glob.glob(os.path.join(LOG_DIR, 'transactions_*.csv'))):
+        filename = os.path.basename(path)
+        month = filename[len('transactions_'):-len('.csv')]
+        if (start and month < start[:7]) or (end and month > end[:7]):
+            continue
+        
+        # The write lock keeps two workers from scanning and saving the same rows
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            file_days = update_report_file(conn, filename)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        days.update({day: agg for day, agg in file_days.items()
+                     if (not start or day >= start) and (not end or day <= end)})
+    return days
+
+def build_report(start=None, end=None):
+    """Merge per-day aggregates into totals by payment type, category, fee coverage, day and hour"""
+    report = {
+        'start': start, 'end': end, 'totals': empty_report_totals(), 'by_status': {},
+        'by_payment_type': {}, 'by_category': {}, 'by_cover_fees': {}, 'by_day': {}, 'by_hour': {}
+    }
+    
+    def merge(target, totals):
+        for key, value in totals.items():
+            target[key] = target.get(key, 0) + value
+    
+    for day, agg in sorted(collect_report_days(start, end).items()):
+        merge(report['totals'], agg['total'])
+        merge(report['by_status'], agg['status'])
+        report['by_day'][day] = agg['total']
+        for dim in ('payment_type', 'category', 'cover_fees', 'hour'):
+            for key, totals in agg[dim].items():
+                merge(report[f"by_{dim}"].setdefault(key, {}), totals)
+    return report
+
+# Local payment state store, kept current by Stripe webhooks and status lookups
+FINAL_PAYMENT_STATUSES = {'succeeded', 'canceled', 'payment_failed'}
+PAYMENT_STATE_RETENTION = 24 * 60 * 60  # Drop settled entries after a day
+payment_states = {}
+payment_states_lock = threading.Lock()
+payment_states_changed = threading.Condition(payment_states_lock)
+
+def record_payment_state(payment_intent_id, status, amount=None, metadata=None, **extra):
+    """Store the latest known state of a PaymentIntent and return a copy of it"""
+    now = time.time()
+    with payment_states_lock:
+        state = payment_states.get(payment_intent_id)
+        if state is None:
+            state = {'id': payment_intent_id, 'status': status, 'amount': amount, 'metadata': {}}
+            payment_states[payment_intent_id] = state
+        
+        # Late or replayed events must not move a settled payment back to in-progress
+        if not (state['status'] in FINAL_PAYMENT_STATUSES and status not in FINAL_PAYMENT_STATUSES):
+            state['status'] = status
+        if amount is not None:
+            state['amount'] = amount
+        if metadata:
+            # Merge so locally added flags (e.g. emails_sent) survive stale event payloads
+            state['metadata'].update(dict(metadata))
+        state.update(extra)
+        state['updated_at'] = now
+        payment_states_changed.notify_all()
+        
+        if len(payment_states) > 1000:
+            for pi_id in [k for k, v in payment_states.items() if now - v['updated_at'] > PAYMENT_STATE_RETENTION]:
+                del payment_states[pi_id]
+        
+        result = {**state, 'metadata': dict(state['metadata'])}
+    
+    # A settled payment no longer needs its reader
+    if result['status'] in FINAL_PAYMENT_STATUSES:
+        release_reader(payment_intent_id)
+    return result
+
+def webhooks_active():
+    """True while verified Stripe webhooks are arriving, so stored state is kept current without polling"""
+    last = _last_webhook_at
+    return last is not None and time.monotonic() - last < WEBHOOK_ACTIVE_WINDOW
+
+def payment_stream_check_interval():
+    return PAYMENT_STREAM_CHECK_INTERVAL_WEBHOOKS if webhooks_active() else PAYMENT_STREAM_CHECK_INTERVAL_POLLING
+
+def get_payment_state(payment_intent_id):
+    """Return the stored state if it can answer a status request without asking Stripe"""
+    with payment_states_lock:
+        state = payment_states.get(payment_intent_id)
+        if not state or state['amount'] is None:
+            return None
+        
+        # Settled payments never change; in-progress ones are only trusted while webhooks keep them current
+        fresh = webhooks_active() and time.time() - state['updated_at'] < PAYMENT_STATE_MAX_AGE
+        if state['status'] in FINAL_PAYMENT_STATUSES or fresh:
+            return {**state, 'metadata': dict(state['metadata'])}
+    
+    return None
+
+def wait_for_payment_state(payment_intent_id, known_status, timeout):
+    """Block until the stored status differs from known_status or the timeout passes"""
+    deadline = time.monotonic() + timeout
+    with payment_states_changed:
+        while True:
+            state = payment_states.get(payment_intent_id)
+            if state and state['status'] != known_status:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            payment_states_changed.wait(remaining)
+
+# PaymentIntent retrieval: concurrent lookups for one id share a single Stripe call
+_payment_intent_cache = OrderedDict()  # id -> (payment_intent, fetched_at)
+_payment_intent_inflight = {}  # id -> {'done': Event, 'result' or 'error'}
+_payment_intent_cache_lock = threading.Lock()
+payment_intent_cache_stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+def retrieve_payment_intent(payment_intent_id):
+    """Retrieve a PaymentIntent through the single-flight cache"""
+    with _payment_intent_cache_lock:
+        cached = _payment_intent_cache.get(payment_intent_id)
+        if cached:
+            payment_intent, fetched_at = cached
+            if payment_intent.status in ('succeeded', 'canceled') or time.monotonic() - fetched_at < PAYMENT_INTENT_CACHE_TTL:
+                payment_intent_cache_stats['hits'] += 1
+                _payment_intent_cache.move_to_end(payment_intent_id)
+                return payment_intent
+        
+        call = _payment_intent_inflight.get(payment_intent_id)
+        leader = call is None
+        if leader:
+            call = {'done': threading.Event()}
+            _payment_intent_inflight[payment_intent_id] = call
+            payment_intent_cache_stats['misses'] += 1
+        else:
+            payment_intent_cache_stats['coalesced'] += 1
+    
+    if not leader:
+        call['done'].wait()
+        if 'error' in call:
+            raise call['error']
+        return call['result']
+    
+    try:
+        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        call['result'] = payment_intent
+        with _payment_intent_cache_lock:
+            _payment_intent_cache[payment_intent_id] = (payment_intent, time.monotonic())
+            _payment_intent_cache.move_to_end(payment_intent_id)
+            while len(_payment_intent_cache) > PAYMENT_INTENT_CACHE_SIZE:
+                _payment_intent_cache.popitem(last=False)
+        return payment_intent
+    except Exception as e:
+        call['error'] = e
+        raise
+    finally:
+        with _payment_intent_cache_lock:
+            _payment_intent_inflight.pop(payment_intent_id, None)
+        call['done'].set()
+
+def invalidate_payment_intent(payment_intent_id):
+    """Drop a cached PaymentIntent after we change it in Stripe"""
+    with _payment_intent_cache_lock:
+        _payment_intent_cache.pop(payment_intent_id, None)
+
+def get_payment_intent_cache_stats():
+    """Hit/miss counters; hits plus coalesced lookups are Stripe calls saved"""
+    with _payment_intent_cache_lock:
+        return {
+            **payment_intent_cache_stats,
+            'stripe_calls_saved': payment_intent_cache_stats['hits'] + payment_intent_cache_stats['coalesced'],
+            'cached': len(_payment_intent_cache),
+        }
+
+def refresh_payment_state(payment_intent_id):
+    """Fetch a PaymentIntent from Stripe and record it in the state store"""
+    payment_intent = retrieve_payment_intent(payment_intent_id)
+    # A declined card puts a dispatched intent back in requires_payment_method: the reader is free again
+    if payment_intent.status == 'requires_payment_method' and payment_intent.last_payment_error:
+        release_reader(payment_intent.id)
+    return record_payment_state(
+        payment_intent.id, payment_intent.status,
+        payment_intent.amount, payment_intent.metadata
+    )
+
+# PaymentIntent pool: ready intents for membership and raffle package amounts, claimed at checkout
+_payment_intent_pool = {}  # amount -> deque of (payment_intent, created_at)
+_payment_intent_pool_lock = threading.Lock()
+_payment_intent_pool_wakeup = threading.Event()
+_payment_intent_pool_closed = threading.Event()
+_payment_intent_pool_thread = None
+_pool_checkouts = OrderedDict()  # checkout_id -> (payment_intent, amount) for pooled and created intents alike
+payment_intent_pool_stats = {'hits': 0, 'misses': 0, 'created': 0, 'cancelled': 0}
+
+def payment_intent_pool_amounts():
+    """Amounts worth keeping ready: membership and raffle package prices, with and without covered fees"""
+    base_amounts = [INDIVIDUAL_MEMBERSHIP_AMOUNT, HOUSEHOLD_MEMBERSHIP_AMOUNT]
+    if RAFFLE_ENABLED:
+        base_amounts.extend(amount for _, amount in RAFFLE_PACKAGES)
+    return sorted({amount for base in base_amounts for amount in (base, calculate_total_with_fees(base))})
+
+def start_payment_intent_pool():
+    """Start the refill thread once per process, if the pool is enabled"""
+    global _payment_intent_pool_thread
+    if PAYMENT_INTENT_POOL_SIZE <= 0 or _payment_intent_pool_thread:
+        return
+    with _payment_intent_pool_lock:
+        if _payment_intent_pool_thread:
+            return
+        for amount in payment_intent_pool_amounts():
+            _payment_intent_pool.setdefault(amount, deque())
+        _payment_intent_pool_thread = threading.Thread(target=payment_intent_pool_worker, name='payment-intent-pool', daemon=True)
+        _payment_intent_pool_thread.start()
+    atexit.register(drain_payment_intent_pool)
+    logger.info(f"Started PaymentIntent pool: {PAYMENT_INTENT_POOL_SIZE} per amount for {len(_payment_intent_pool)} amounts")
+
+def cancel_pooled_payment_intent(payment_intent_id):
+    try:
+        stripe.PaymentIntent.cancel(payment_intent_id)
+        with _payment_intent_pool_lock:
+            payment_intent_pool_stats['cancelled'] += 1
+    except Exception as e:
+        logger.warning(f"Could not cancel pooled PaymentIntent {payment_intent_id}: {str(e)}")
+
+def refill_payment_intent_pool():
+    """Cancel expired pooled intents and top every amount back up"""
+    now = time.monotonic()
+    expired = []
+    shortfall = {}
+    with _payment_intent_pool_lock:
+        for amount, ready in _payment_intent_pool.items():
+            while ready and now - ready[0][1] > PAYMENT_INTENT_POOL_MAX_AGE:
+                expired.append(ready.popleft()[0].id)
+            shortfall[amount] = PAYMENT_INTENT_POOL_SIZE - len(ready)
+    
+    for payment_intent_id in expired:
+        cancel_pooled_payment_intent(payment_intent_id)
+    
+    for amount, missing in shortfall.items():
+        for _ in range(missing):
+            payment_intent = stripe.PaymentIntent.create(
+                amount=amount,
+                currency='usd',
+                payment_method_types=['card_present'],
+                capture_method='automatic',
+                description='POS payment (unclaimed)',
+                metadata={'pos_pool': 'available'}
+            )
+            if _payment_intent_pool_closed.is_set():
+                cancel_pooled_payment_intent(payment_intent.id)
+                return
+            with _payment_intent_pool_lock:
+                _payment_intent_pool[amount].append((payment_intent, time.monotonic()))
+                payment_intent_pool_stats['created'] += 1
+
+def payment_intent_pool_worker():
+    """Keep the pool topped up until the process exits"""
+    load_stripe()
+    while True:
+        _payment_intent_pool_wakeup.clear()
+        try:
+            refill_payment_intent_pool()
+        except Exception as e:
+            logger.error(f"Error refilling PaymentIntent pool: {str(e)}")
+        _payment_intent_pool_wakeup.wait(PAYMENT_INTENT_POOL_REFILL_INTERVAL)
+
+def drain_payment_intent_pool():
+    """Cancel every unclaimed pooled intent; registered to run at exit"""
+    _payment_intent_pool_closed.set()
+    with _payment_intent_pool_lock:
+        unclaimed = [payment_intent.id for ready in _payment_intent_pool.values() for payment_intent, _ in ready]
+        for ready in _payment_intent_pool.values():
+            ready.clear()
+    for payment_intent_id in unclaimed:
+        cancel_pooled_payment_intent(payment_intent_id)
+    if unclaimed:
+        logger.info(f"Cancelled {len(unclaimed)} unclaimed pooled PaymentIntents")
+
+def _checkout_payment_intent(checkout_id, amount):
+    """The intent a checkout_id already opened, or None; raises ValueError on a different amount (caller holds the lock)"""
+    if not checkout_id or checkout_id not in _pool_checkouts:
+        return None
+    payment_intent, opened_amount = _pool_checkouts[checkout_id]
+    if opened_amount != amount:
+        # Same as Stripe's idempotency check: a reused checkout_id must describe the same payment
+        raise ValueError('checkout_id was already used for a different amount')
+    return payment_intent
+
+def _remember_checkout(checkout_id, payment_intent, amount):
+    """Record the intent a checkout_id opened, so a resubmit reuses it (caller holds the lock)"""
+    if checkout_id:
+        _pool_checkouts[checkout_id] = (payment_intent, amount)
+        while len(_pool_checkouts) > 100:
+            _pool_checkouts.popitem(last=False)
+
+def find_checkout_payment_intent(checkout_id, amount):
+    """The intent already opened for a resubmitted checkout, pooled or created, or None"""
+    with _payment_intent_pool_lock:
+        return _checkout_payment_intent(checkout_id, amount)
+
+def remember_checkout_payment_intent(checkout_id, payment_intent, amount):
+    with _payment_intent_pool_lock:
+        _remember_checkout(checkout_id, payment_intent, amount)
+
+def claim_pooled_payment_intent(amount, checkout_id, description, metadata):
+    """Take a ready PaymentIntent for this amount, or None if the pool has none
+    
+    Raises ValueError if checkout_id already opened an intent for a different amount.
+    """
+    with _payment_intent_pool_lock:
+        # Checked again under the lock, so simultaneous resubmits can't claim two intents
+        existing = _checkout_payment_intent(checkout_id, amount)
+        if existing:
+            return existing
+        ready = _payment_intent_pool.get(amount)
+        if not ready:
+            if ready is not None:
+                payment_intent_pool_stats['misses'] += 1
+            return None
+        payment_intent, _ = ready.popleft()
+        payment_intent_pool_stats['hits'] += 1
+        _remember_checkout(checkout_id, payment_intent, amount)
+    _payment_intent_pool_wakeup.set()
+    
+    # The local state carries the metadata from here on, so the Stripe copy can follow in the background;
+    # an empty pos_pool value removes the marker
+    threading.Thread(
+        target=patch_pooled_payment_intent, args=(payment_intent.id, description, {**metadata, 'pos_pool': ''}),
+        name=f"patch-{payment_intent.id}", daemon=True
+    ).start()
+    return payment_intent
+
+def patch_pooled_payment_intent(payment_intent_id, description, metadata):
+    """Write a claimed intent's checkout details to Stripe"""
+    for attempt in range(3):
+        try:
+            stripe.PaymentIntent.modify(payment_intent_id, description=description, metadata=metadata)
+            invalidate_payment_intent(payment_intent_id)
+            return
+        except Exception as e:
+            logger.warning(f"Error updating pooled PaymentIntent {payment_intent_id} (attempt {attempt + 1}): {str(e)}")
+            time.sleep(2 ** attempt)
+    logger.error(f"Pooled PaymentIntent {payment_intent_id} kept its placeholder metadata in Stripe")
+
+def get_payment_intent_pool_stats():
+    """Ready intents per amount plus claim counters"""
+    with _payment_intent_pool_lock:
+        return {
+            **payment_intent_pool_stats,
+            'size': PAYMENT_INTENT_POOL_SIZE,
+            'ready': {str(amount): len(ready) for amount, ready in _payment_intent_pool.items()},
+        }
+
+# Reader registry: cached Terminal readers, refreshed on a TTL and invalidated on registration
+_reader_registry = {'all_readers': [], 'readers': {}, 'fetched_at': None}
+_reader_registry_lock = threading.Lock()
+_reader_refresh_lock = threading.Lock()
+
+def refresh_reader_registry():
+    """List the account's readers from Stripe in one call and cache them"""
+    all_readers = list(stripe.terminal.Reader.list(limit=100).auto_paging_iter())
+    with _reader_registry_lock:
+        _reader_registry['all_readers'] = all_readers
+        _reader_registry['readers'] = {r.id: r for r in all_readers if r.location == STRIPE_LOCATION_ID}
+        _reader_registry['fetched_at'] = time.monotonic()
+        logger.info(f"Reader registry refreshed: {len(_reader_registry['readers'])} of {len(all_readers)} readers in location {STRIPE_LOCATION_ID}")
+        return list(_reader_registry['readers'].values())
+
+def get_location_readers(force_refresh=False):
+    """Return the readers in STRIPE_LOCATION_ID, listing them from Stripe only when the cache is stale"""
+    def cached():
+        with _reader_registry_lock:
+            fetched_at = _reader_registry['fetched_at']
+            if fetched_at is not None and time.monotonic() - fetched_at < READER_CACHE_TTL:
+                return list(_reader_registry['readers'].values())
+        return None
+    
+    if not force_refresh:
+        readers = cached()
+        if readers is not None:
+            return readers
+    
+    # Only one request refreshes at a time; the others wait for and reuse its result
+    with _reader_refresh_lock:
+        if not force_refresh:
+            readers = cached()
+            if readers is not None:
+                return readers
+        return refresh_reader_registry()
+
+def get_all_readers():
+    """Return every reader in the account from the last registry refresh"""
+    with _reader_registry_lock:
+        return list(_reader_registry['all_readers'])
+
+def invalidate_reader_registry():
+    """Force the next reader lookup to list readers from Stripe"""
+    with _reader_registry_lock:
+        _reader_registry['fetched_at'] = None
+
+def get_reader_registry_stats():
+    """Summarize the reader cache"""
+    with _reader_registry_lock:
+        fetched_at = _reader_registry['fetched_at']
+        return {
+            'readers': len(_reader_registry['readers']),
+            'age_seconds': round(time.monotonic() - fetched_at, 1) if fetched_at is not None else None,
+            'ttl_seconds': READER_CACHE_TTL,
+        }
+
+def update_cached_reader(reader):
+    """Replace a cached reader with a newer copy, e.g. from a webhook event"""
+    with _reader_registry_lock:
+        if reader['id'] in _reader_registry['readers']:
+            _reader_registry['readers'][reader['id']] = reader
+            _reader_registry['all_readers'] = [reader if r.id == reader['id'] else r for r in _reader_registry['all_readers']]
+
+# Reader scheduler: one payment per reader at a time, tablets pinned to their reader, FIFO queue when all are busy
+_reader_leases = {}  # reader_id -> {'payment_intent_id', 'session_id', 'since'}
+_reader_pins = {}  # session_id -> {'reader_id', 'last_used'}; at most one session per reader
+READER_PIN_IDLE_SECONDS = 1800  # A tablet unused this long gives up its reader for others to pin
+_reader_last_assigned = {}  # reader_id -> monotonic time of last assignment
+_reader_queue = []  # [{'payment_intent_id', 'session_id', 'last_seen'}] in arrival order
+_reader_scheduler_lock = threading.Lock()
+
+def _expire_reader_schedule(now):
+    """Drop leases and queue entries that have outlived their timeouts (caller holds the lock)"""
+    for reader_id in [r for r, lease in _reader_leases.items() if now - lease['since'] > READER_LEASE_SECONDS]:
+        logger.warning(f"Reader {reader_id} lease for {_reader_leases[reader_id]['payment_intent_id']} expired")
+        del _reader_leases[reader_id]
+    _reader_queue[:] = [entry for entry in _reader_queue if now - entry['last_seen'] <= READER_QUEUE_TIMEOUT]
+    for session_id in [s for s, pin in _reader_pins.items() if now - pin['last_used'] > READER_PIN_IDLE_SECONDS]:
+        del _reader_pins[session_id]
+
+def _pick_idle_reader(session_id, idle_ids, eligible):
+    """Choose a reader for a session from the idle set, or None if it must wait (caller holds the lock)"""
+    pin = _reader_pins.get(session_id) if session_id else None
+    if pin and pin['reader_id'] in idle_ids:
+        # A tablet uses the reader next to it whenever that reader is free
+        return pin['reader_id']
+    
+    pinned_elsewhere = {p['reader_id'] for s, p in _reader_pins.items() if s != session_id}
+    if pin:
+        # Its own reader is busy: borrow an idle one no other tablet is pinned to, or wait
+        idle_ids = [r for r in idle_ids if r not in pinned_elsewhere]
+    if not idle_ids:
+        return None
+    # Prefer readers no other tablet is pinned to, then the least recently used one
+    return min(idle_ids, key=lambda r: (r in pinned_elsewhere, _reader_last_assigned.get(r, 0)))
+
+def _pin_reader(session_id, reader_id, eligible, now):
+    """Remember a tablet's reader, unless another tablet already has it (caller holds the lock)"""
+    pin = _reader_pins.get(session_id)
+    if pin and pin['reader_id'] in eligible:
+        # Keep the tablet's own reader even while it borrows another one
+        pin['last_used'] = now
+        return
+    if any(p['reader_id'] == reader_id for s, p in _reader_pins.items() if s != session_id):
+        return
+    _reader_pins[session_id] = {'reader_id': reader_id, 'last_used': now}
+
+def _replace_session_payment(session_id, payment_intent_id):
+    """A tablet runs one checkout at a time: its new payment takes over any lease or queue slot it still holds
+    
+    Without webhooks a declined card or an abandoned payment never reaches a final status, so the old lease
+    would otherwise keep the tablet waiting on its own reader (caller holds the lock).
+    """
+    for reader_id in [r for r, lease in _reader_leases.items()
+                      if lease['session_id'] == session_id and lease['payment_intent_id'] != payment_intent_id]:
+        logger.info(f"Reader {reader_id} lease for {_reader_leases[reader_id]['payment_intent_id']} "
+                    f"replaced by {payment_intent_id} from the same tablet")
+        del _reader_leases[reader_id]
+    _reader_queue[:] = [e for e in _reader_queue if e['session_id'] != session_id]
+
+def acquire_reader(payment_intent_id, session_id, readers):
+    """Reserve a reader for a payment; returns (reader_id, None) or (None, queue_position)"""
+    now = time.monotonic()
+    # Readers known to be offline are skipped unless that leaves nothing to try
+    eligible = [r.id for r in readers if r.status != 'offline'] or [r.id for r in readers]
+    
+    with _reader_scheduler_lock:
+        _expire_reader_schedule(now)
+        
+        for reader_id, lease in _reader_leases.items():
+            if lease['payment_intent_id'] == payment_intent_id:
+                return reader_id, None
+        
+        entry = next((e for e in _reader_queue if e['payment_intent_id'] == payment_intent_id), None)
+        if entry is None:
+            if session_id:
+                _replace_session_payment(session_id, payment_intent_id)
+            entry = {'payment_intent_id': payment_intent_id, 'session_id': session_id}
+            _reader_queue.append(entry)
+        entry['last_seen'] = now
+        
+        # Earlier arrivals get first pick of the idle readers
+        idle_ids = [r for r in eligible if r not in _reader_leases]
+        for position, queued in enumerate(_reader_queue, start=1):
+            reader_id = _pick_idle_reader(queued['session_id'], idle_ids, eligible)
+            if queued is entry:
+                if reader_id is None:
+                    return None, position
+                break
+            if reader_id is not None:
+                idle_ids.remove(reader_id)
+        
+        _reader_queue.remove(entry)
+        _reader_leases[reader_id] = {'payment_intent_id': payment_intent_id, 'session_id': session_id, 'since': now}
+        _reader_last_assigned[reader_id] = now
+        if session_id:
+            _pin_reader(session_id, reader_id, eligible, now)
+        return reader_id, None
+
+def release_reader(payment_intent_id):
+    """Free whatever reader or queue slot a payment holds"""
+    with _reader_scheduler_lock:
+        for reader_id in [r for r, lease in _reader_leases.items() if lease['payment_intent_id'] == payment_intent_id]:
+            del _reader_leases[reader_id]
+            logger.info(f"Reader {reader_id} released by {payment_intent_id}")
+        _reader_queue[:] = [e for e in _reader_queue if e['payment_intent_id'] != payment_intent_id]
+
+def hold_reader(reader_id, seconds):
+    """Treat a reader as busy for a while, e.g. when Stripe reports it busy with another action"""
+    with _reader_scheduler_lock:
+        _reader_leases[reader_id] = {
+            'payment_intent_id': None, 'session_id': None,
+            'since': time.monotonic() - READER_LEASE_SECONDS + seconds
+        }
+
+def get_busy_reader_ids():
+    """Return the ids of readers currently reserved by a payment"""
+    with _reader_scheduler_lock:
+        _expire_reader_schedule(time.monotonic())
+        return set(_reader_leases)
+
+def get_reader_scheduler_stats():
+    """Summarize reader leases, pins and the wait queue"""
+    now = time.monotonic()
+    with _reader_scheduler_lock:
+        _expire_reader_schedule(now)
+        return {
+            'busy_readers': {r: {'payment_intent_id': lease['payment_intent_id'], 'seconds': round(now - lease['since'], 1)}
+                             for r, lease in _reader_leases.items()},
+            'pinned_sessions': len(_reader_pins),
+            'queue_length': len(_reader_queue),
+        }
+
+def handle_stripe_event(event):
+    """Apply a verified Stripe webhook event to the payment state store"""
+    event_type = event['type']
+    obj = event['data']['object']
+    
+    if event_type == 'payment_intent.succeeded':
+        settle_payment_state(record_payment_state(obj['id'], 'succeeded', obj['amount'], obj.get('metadata')))
+    elif event_type == 'payment_intent.payment_failed':
+        error = obj.get('last_payment_error') or {}
+        settle_payment_state(record_payment_state(obj['id'], 'payment_failed', obj['amount'], obj.get('metadata'),
+                                                  failure_message=error.get('message')))
+    elif event_type == 'payment_intent.canceled':
+        settle_payment_state(record_payment_state(obj['id'], 'canceled', obj['amount'], obj.get('metadata')))
+    elif event_type.startswith('terminal.reader.action_'):
+        action = obj.get('action') or {}
+        payment_intent_id = (action.get('process_payment_intent') or {}).get('payment_intent')
+        logger.info(f"Reader {obj['id']} {event_type.rsplit('.', 1)[-1]} for {payment_intent_id}")
+        update_cached_reader(obj)
+        
+        # A declined card leaves the intent in requires_payment_method, so surface it as failed
+        if event_type == 'terminal.reader.action_failed' and payment_intent_id:
+            settle_payment_state(record_payment_state(payment_intent_id, 'payment_failed',
+                                                      failure_message=action.get('failure_message')))
+    else:
+        logger.info(f"Ignoring Stripe event {event_type}")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+# Endpoints that never call Stripe, so a cold worker answers them while the SDK is still loading
+STRIPELESS_ENDPOINTS = {'health', 'metrics', 'static', 'static_build'}
+
+@app.before_request
+def require_stripe():
+    if request.endpoint not in STRIPELESS_ENDPOINTS:
+        load_stripe()
+
 @app.before_request
 def before_request():
     """Handle domain redirects before processing requests"""
@@ -141,111 +1325,491 @@ def before_request():
     if redirect_response:
         return redirect_response
 
-@app.after_request
-def after_request(response):
-    """Add security headers including Content Security Policy"""
-    # Content Security Policy to prevent mixed content and upgrade insecure requests
-    csp = (
+STATIC_BUILD_DIR = os.path.join(app.static_folder, 'build')
+
+def load_static_manifest():
+    """Read the manifest written by build_static.py; empty when the app runs from unbuilt templates"""
+    try:
+        with open(os.path.join(STATIC_BUILD_DIR, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Ignoring unreadable static build manifest: {str(e)}")
+        return {}
+
+STATIC_MANIFEST = load_static_manifest()
+# Built pages load Bootstrap from static/build unless the build couldn't download it
+BOOTSTRAP_SOURCE = ' https://cdn.jsdelivr.net' if STATIC_MANIFEST.get('bootstrap_cdn', True) else ''
+
+def page_template(template_name):
+    """The built variant of a page (external, fingerprinted CSS/JS) when one exists"""
+    return STATIC_MANIFEST.get('pages', {}).get(template_name, template_name)
+
+# Security headers, built once rather than per response
+SECURITY_HEADERS = {
+    # Content Security Policy to prevent mixed content and upgrade insecure requests.
+    # 'unsafe-inline' stays for the pages' onclick handlers and style attributes
+    'Content-Security-Policy': (
         "default-src 'self' https:; "
-        "script-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net https://js.stripe.com; "
-        "style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
+        f"script-src 'self' 'unsafe-inline'{BOOTSTRAP_SOURCE} https://js.stripe.com; "
+        f"style-src 'self' 'unsafe-inline'{BOOTSTRAP_SOURCE}; "
         "img-src 'self' data: https:; "
-        "font-src 'self' https://cdn.jsdelivr.net; "
+        f"font-src 'self'{BOOTSTRAP_SOURCE}; "
         "connect-src 'self' https://api.stripe.com; "
+        "object-src 'none'; base-uri 'self'; frame-ancestors 'none'; "
         "upgrade-insecure-requests"
-    )
-    response.headers['Content-Security-Policy'] = csp
+    ),
+    'Strict-Transport-Security': 'max-age=31536000; includeSubDomains',
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+}
+
+# Response compression: HTML and JSON bodies only; streams (SSE, CSV exports) pass through untouched
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json'}
+COMPRESS_MIN_BYTES = 1024
+
+def gzip_bytes(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    return compressor.compress(data) + compressor.flush()
+
+def compress_body(data, encoding, level=6):
+    """Encode a body as 'br' or 'gzip'"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip_bytes(data, level)
+
+def negotiate_encoding():
+    """Pick br or gzip from the request's Accept-Encoding, or None for an uncompressed response"""
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+def encoded_etag(etag, encoding):
+    """Each encoding of a body is a separate representation, so it gets its own strong ETag"""
+    return f"{etag}-{encoding}" if encoding else etag
+
+def is_not_modified(etag):
+    """True if If-None-Match names any encoding of the content with this ETag"""
+    return any(request.if_none_match.contains_weak(encoded_etag(etag, encoding)) for encoding in (None, 'gzip', 'br'))
+
+# Pages whose template inputs are all startup config: rendered and compressed once, then served from memory
+_rendered_pages = {}
+_rendered_pages_lock = threading.Lock()
+
+def rendered_page_response(template_name, **context):
+    """Serve a pre-rendered page with a strong ETag, answering revalidations with 304"""
+    with _rendered_pages_lock:
+        page = _rendered_pages.get(template_name)
+    if page is None:
+        body = render_template(page_template(template_name), **context).encode('utf-8')
+        page = {
+            'etag': hashlib.sha256(body).hexdigest()[:20],
+            None: body,
+            'gzip': gzip_bytes(body, 9),
+            'br': compress_body(body, 'br', 11) if brotli else None,
+        }
+        with _rendered_pages_lock:
+            _rendered_pages[template_name] = page
+    
+    encoding = negotiate_encoding()
+    if is_not_modified(page['etag']):
+        response = Response(status=304)
+    else:
+        response = Response(page[encoding], mimetype='text/html')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(encoded_etag(page['etag'], encoding))
+    response.vary.add('Accept-Encoding')
+    # Revalidate every load; an unchanged page costs one 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/static/build/<path:filename>')
+def static_build(filename):
+    """Serve fingerprinted build assets, precompressed when the client accepts it"""
+    available = [encoding for encoding, suffix in (('br', '.br'), ('gzip', '.gz'))
+                 if os.path.isfile(safe_join(STATIC_BUILD_DIR, filename + suffix) or '')]
+    encoding = request.accept_encodings.best_match(available) if available else None
+    suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = send_from_directory(STATIC_BUILD_DIR, filename + suffix, mimetype=mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if available:
+        response.vary.add('Accept-Encoding')
+    # The content hash is in the filename, so a file never changes once published
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.after_request
+def after_request(response):
+    """Add security headers, answer conditional GETs for JSON and compress HTML and JSON bodies"""
+    response.headers.update(SECURITY_HEADERS)
     
-    # Additional security headers
-    response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
     
+    body = response.get_data()
+    etag = None
+    if request.method == 'GET' and 'ETag' not in response.headers:
+        etag = hashlib.sha256(body).hexdigest()[:20]
+        if is_not_modified(etag):
+            response.status_code = 304
+            response.set_data(b'')
+            response.headers.pop('Content-Length', None)
+            response.set_etag(etag)
+            return response
+    
+    encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding()
+        if encoding:
+            response.set_data(compress_body(body, encoding))
+            response.headers['Content-Encoding'] = encoding
+            existing = response.headers.get('ETag')
+            if existing and not existing.startswith('W/'):
+                # A view's own ETag names the uncompressed body
+                response.headers['ETag'] = 'W/' + existing
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding))
     return response
 
+@app.after_request
+def record_request_metrics(response):
+    """Time each request by route pattern, so payment ids don't become separate series"""
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe_metric('pos_http_request_duration_seconds', time.monotonic() - started,
+                       route=route, method=request.method, status=response.status_code)
+    return response
+
+# Process-wide Gmail credentials, shared by every sender thread
+_gmail_lock = threading.Lock()
+_gmail_credentials = None
+_gmail_auth_request = None
+# Gmail API clients are per thread because their httplib2 transport is not thread-safe
+_gmail_local = threading.local()
+
 def get_gmail_credentials():
-    """Get valid Gmail credentials using OAuth2"""
+    """Get valid Gmail credentials using OAuth2, refreshing only near token expiry"""
+    global _gmail_credentials, _gmail_auth_request
     if not all([GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REFRESH_TOKEN]):
         logger.warning("OAuth2 configuration incomplete")
         return None
     
-    try:
-        # Create credentials from the refresh token
-        credentials = Credentials(
-            token=None,
-            refresh_token=GOOGLE_REFRESH_TOKEN,
-            token_uri='https://oauth2.googleapis.com/token',
-            client_id=GOOGLE_CLIENT_ID,
-            client_secret=GOOGLE_CLIENT_SECRET,
-            scopes=SCOPES
-        )
-        
-        # Refresh the token if needed
-        if not credentials.valid:
-            credentials.refresh(Request())
-        
-        return credentials
+    with _gmail_lock:
+        try:
+            if _gmail_credentials is None:
+                # google-auth is only needed once the first email goes out
+                from google.auth.transport.requests import Request
+                from google.oauth2.credentials import Credentials
+                
+                # Create credentials from the refresh token
+                _gmail_credentials = Credentials(
+                    token=None,
+                    refresh_token=GOOGLE_REFRESH_TOKEN,
+                    token_uri='https://oauth2.googleapis.com/token',
+                    client_id=GOOGLE_CLIENT_ID,
+                    client_secret=GOOGLE_CLIENT_SECRET,
+                    scopes=SCOPES
+                )
+                # One keep-alive session for all token refreshes
+                _gmail_auth_request = Request(session=requests.Session())
+            
+            credentials = _gmail_credentials
+            expiry = credentials.expiry  # Naive UTC, as google-auth stores it
+            if not credentials.token or not expiry or expiry - datetime.utcnow() < GMAIL_TOKEN_REFRESH_MARGIN:
+                credentials.refresh(_gmail_auth_request)
+                logger.info(f"Refreshed Gmail access token (expires {credentials.expiry} UTC)")
+            
+            return credentials
+            
+        except Exception as e:
+            logger.error(f"Failed to get Gmail credentials: {str(e)}")
+            return None
+
+def get_gmail_service(credentials):
+    """Return this thread's Gmail API client, building it on first use"""
+    service = getattr(_gmail_local, 'service', None)
+    if service is None:
+        from googleapiclient.discovery import build
         
-    except Exception as e:
-        logger.error(f"Failed to get Gmail credentials: {str(e)}")
-        return None
+        # The client holds a reference to the shared credentials, so in-place refreshes apply to it
+        service = build('gmail', 'v1', credentials=credentials, cache_discovery=False)
+        _gmail_local.service = service
+    return service
 
-def send_email(to_email, subject, body, is_html=False, attachments=None):
-    """Send an email using Gmail API with optional attachments"""
-    if not FROM_EMAIL:
-        logger.warning("FROM_EMAIL not configured - skipping email send")
-        return False
+class RecipientsRejected(Exception):
+    """Raised by a mail transport when the server refuses recipients rather than failing outright
     
+    refused lists the addresses it named (empty when the message was rejected as a whole, e.g. a
+    malformed To header) and delivered says whether the remaining recipients still got the message.
+    """
+    def __init__(self, refused, delivered, message):
+        super().__init__(message)
+        self.refused = refused
+        self.delivered = delivered
+
+def send_via_gmail(msg, recipients):
+    """Gmail API transport: returns the Gmail message id, or None without valid credentials"""
     credentials = get_gmail_credentials()
     if not credentials:
-        logger.warning("Could not get valid credentials - skipping email send")
+        return None
+    from googleapiclient.errors import HttpError
+    
+    service = get_gmail_service(credentials)
+    raw_message = base64.urlsafe_b64encode(msg.as_bytes()).decode()
+    try:
+        message = service.users().messages().send(userId='me', body={'raw': raw_message}).execute()
+    except HttpError as e:
+        # 400 means the message itself was refused (invalid To header); 5xx and the rest are worth retrying as is
+        if e.resp.status == 400:
+            raise RecipientsRejected([], False, f"Gmail rejected the message: {e}") from e
+        raise
+    return message['id']
+
+# SMTP sessions shared by every sender thread: (connection, last used) with the most recently used last
+_smtp_pool = deque()
+_smtp_pool_lock = threading.Lock()
+
+def open_smtp_connection():
+    """Connect to SMTP_SERVER, upgrade with STARTTLS and log in"""
+    smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    try:
+        smtp.ehlo()
+        if SMTP_STARTTLS:
+            smtp.starttls(context=ssl.create_default_context())
+            smtp.ehlo()
+        if SMTP_USERNAME:
+            smtp.login(SMTP_USERNAME, SMTP_PASSWORD or '')
+    except Exception:
+        close_smtp_connection(smtp)
+        raise
+    logger.info(f"Opened SMTP session to {SMTP_SERVER}:{SMTP_PORT}")
+    return smtp
+
+def close_smtp_connection(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        smtp.close()
+
+def checkout_smtp_connection():
+    """Take the most recently used pooled session; returns (connection, reused)"""
+    stale = []
+    connection = None
+    with _smtp_pool_lock:
+        while _smtp_pool:
+            smtp, last_used = _smtp_pool.pop()
+            if time.monotonic() - last_used < SMTP_IDLE_TIMEOUT:
+                connection = smtp
+                break
+            stale.append(smtp)
+    # Servers drop idle sessions, so don't bother sending on one that has sat too long
+    for smtp in stale:
+        close_smtp_connection(smtp)
+    if connection:
+        return connection, True
+    return open_smtp_connection(), False
+
+def release_smtp_connection(smtp):
+    """Return a healthy session to the pool, closing it if the pool is full"""
+    with _smtp_pool_lock:
+        if len(_smtp_pool) < SMTP_POOL_SIZE:
+            _smtp_pool.append((smtp, time.monotonic()))
+            return
+    close_smtp_connection(smtp)
+
+def close_smtp_pool():
+    with _smtp_pool_lock:
+        sessions = [smtp for smtp, _ in _smtp_pool]
+        _smtp_pool.clear()
+    for smtp in sessions:
+        close_smtp_connection(smtp)
+
+def send_via_smtp(msg, recipients):
+    """SMTP transport: send on a pooled session, reconnecting once if the server dropped it"""
+    smtp, reused = checkout_smtp_connection()
+    try:
+        try:
+            refused = smtp.send_message(msg, from_addr=FROM_EMAIL, to_addrs=recipients)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            if not reused:
+                raise
+            close_smtp_connection(smtp)
+            smtp = open_smtp_connection()
+            refused = smtp.send_message(msg, from_addr=FROM_EMAIL, to_addrs=recipients)
+    except smtplib.SMTPRecipientsRefused as e:
+        # Every recipient refused: the session itself is fine
+        release_smtp_connection(smtp)
+        raise RecipientsRejected(list(e.recipients), False, f"SMTP server refused every recipient: {e}") from e
+    except Exception:
+        close_smtp_connection(smtp)
+        raise
+    release_smtp_connection(smtp)
+    if refused:
+        raise RecipientsRejected(list(refused), True, f"SMTP server refused {', '.join(refused)} for {msg['Message-ID']}")
+    return msg['Message-ID']
+
+MAIL_TRANSPORTS = {
+    'gmail': send_via_gmail,
+    'smtp': send_via_smtp,
+}
+if MAIL_TRANSPORT not in MAIL_TRANSPORTS:
+    logger.error(f"Unknown MAIL_TRANSPORT '{MAIL_TRANSPORT}', using gmail")
+    MAIL_TRANSPORT = 'gmail'
+if MAIL_TRANSPORT == 'smtp':
+    atexit.register(close_smtp_pool)
+
+def send_email(to_email, subject, body, is_html=False, attachments=None, raise_rejections=False):
+    """Send an email through MAIL_TRANSPORT with optional attachments; to_email may list several addresses
+    
+    Returns True once the message is accepted for at least one recipient. With raise_rejections the
+    caller gets RecipientsRejected instead, so it can tell refused addresses from a failed send.
+    """
+    if not FROM_EMAIL:
+        logger.warning("FROM_EMAIL not configured - skipping email send")
         return False
     
     try:
-        from googleapiclient.discovery import build
-        import email.mime.multipart
-        import email.mime.text
-        
-        # Build Gmail service
-        service = build('gmail', 'v1', credentials=credentials)
-        
         # Create message
         if attachments:
-            msg = email.mime.multipart.MIMEMultipart('related')
+            msg = MIMEMultipart('related')
         else:
-            msg = email.mime.multipart.MIMEMultipart('alternative')
+            msg = MIMEMultipart('alternative')
             
         msg['From'] = FROM_EMAIL
         msg['To'] = to_email
         msg['Subject'] = subject
-        
-        if is_html:
-            msg.attach(email.mime.text.MIMEText(body, 'html'))
-        else:
-            msg.attach(email.mime.text.MIMEText(body, 'plain'))
+        msg['Date'] = email.utils.formatdate(localtime=True)
+        msg['Message-ID'] = email.utils.make_msgid(domain=FROM_EMAIL.rpartition('@')[2] or None)
+        msg.attach(MIMEText(body, 'html' if is_html else 'plain'))
         
         # Add attachments if provided
         if attachments:
             for attachment in attachments:
                 msg.attach(attachment)
         
-        # Encode message
-        raw_message = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-        
-        # Send message
-        message = service.users().messages().send(
-            userId='me', 
-            body={'raw': raw_message}
-        ).execute()
+        recipients = [address for _, address in email.utils.getaddresses([to_email]) if address]
+        started = time.monotonic()
+        message_id = MAIL_TRANSPORTS[MAIL_TRANSPORT](msg, recipients)
+        if message_id is None:
+            logger.warning("Could not get valid credentials - skipping email send")
+            increment_metric('pos_email_send_failures_total', reason='no_credentials', transport=MAIL_TRANSPORT)
+            return False
+        observe_metric('pos_email_send_duration_seconds', time.monotonic() - started, transport=MAIL_TRANSPORT)
         
-        logger.info(f"Email sent successfully to {to_email} (Message ID: {message['id']})")
+        logger.info(f"Email sent successfully to {to_email} via {MAIL_TRANSPORT} (Message ID: {message_id})")
         return True
         
+    except RecipientsRejected as e:
+        logger.warning(f"Email to {to_email} via {MAIL_TRANSPORT}: {str(e)}")
+        increment_metric('pos_email_send_failures_total', reason='recipients_refused', transport=MAIL_TRANSPORT)
+        if raise_rejections:
+            raise
+        return e.delivered
     except Exception as e:
-        logger.error(f"Failed to send email to {to_email}: {str(e)}")
+        logger.error(f"Failed to send email to {to_email} via {MAIL_TRANSPORT}: {str(e)}")
+        increment_metric('pos_email_send_failures_total', reason='error', transport=MAIL_TRANSPORT)
         return False
 
+# Email templates and letterhead, loaded once and reloaded when the file changes on disk
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')
+LOCAL_TEMPLATE_DIR = os.path.join(APP_ROOT, 'local-config', 'templates')
+GENERIC_TEMPLATE_DIR = os.path.join(APP_ROOT, 'templates')
+LETTERHEAD_FILENAME = 'SWCA-letterhead-v3-1024x224.png'
+TEMPLATE_RELOAD_INTERVAL = 5  # Seconds between mtime checks
+
+# Placeholders each template may use; anything else would fail at send time
+EMAIL_TEMPLATE_FIELDS = {
+    'donor_acknowledgment_email.html': {
+        'payer_name', 'amount_formatted', 'payment_date', 'organization_name', 'payment_intent_id',
+        'payment_type', 'payment_type_title', 'membership_message', 'goods_services_statement'
+    },
+    'raffle_purchase_email.html': {
+        'payer_name', 'amount_formatted', 'payment_date', 'organization_name', 'payment_intent_id',
+        'raffle_quantity'
+    },
+}
+
+_email_assets = {}
+_email_assets_lock = threading.Lock()
+
+def read_email_template(path):
+    """Read an email template and check its placeholders against EMAIL_TEMPLATE_FIELDS"""
+    with open(path, 'r', encoding='utf-8') as f:
+        html_template = f.read()
+    
+    allowed = EMAIL_TEMPLATE_FIELDS[os.path.basename(path)]
+    used = {field.split('.')[0].split('[')[0] for _, field, _, _ in string.Formatter().parse(html_template) if field}
+    unknown = used - allowed
+    if unknown:
+        raise ValueError(f"{path} uses unknown placeholders: {', '.join(sorted(unknown))}")
+    return html_template
+
+def read_binary_file(path):
+    """Read a file's bytes"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def load_email_asset(name, loader, search_dirs):
+    """Return a cached email asset, reloading it when the resolved file or its mtime changes"""
+    now = time.monotonic()
+    with _email_assets_lock:
+        entry = _email_assets.get(name)
+        if entry and now - entry['checked_at'] < TEMPLATE_RELOAD_INTERVAL:
+            return entry['value']
+        
+        path = next((os.path.join(d, name) for d in search_dirs if os.path.exists(os.path.join(d, name))), None)
+        mtime = os.path.getmtime(path) if path else None
+        if entry and entry['path'] == path and entry['mtime'] == mtime:
+            entry['checked_at'] = now
+            return entry['value']
+        
+        try:
+            value = loader(path) if path else None
+        except Exception as e:
+            if not entry:
+                raise
+            # Keep serving the last good version rather than breaking receipts on a bad edit
+            logger.error(f"Error reloading email asset {name}, keeping previous version: {str(e)}")
+            entry['checked_at'] = now
+            return entry['value']
+        
+        _email_assets[name] = {'path': path, 'mtime': mtime, 'checked_at': now, 'value': value}
+        logger.info(f"Loaded email asset {name} from {path or 'nowhere (not found)'}")
+        return value
+
+def get_email_template(name):
+    """Return an email template, preferring the local-config version"""
+    html_template = load_email_asset(name, read_email_template, [LOCAL_TEMPLATE_DIR, GENERIC_TEMPLATE_DIR])
+    if html_template is None:
+        raise FileNotFoundError(f"Email template {name} not found")
+    return html_template
+
+def get_letterhead_attachment():
+    """Build the inline letterhead image from cached bytes, or None if there is no local-config letterhead"""
+    img_data = load_email_asset(LETTERHEAD_FILENAME, read_binary_file, [LOCAL_TEMPLATE_DIR])
+    if not img_data:
+        return None
+    
+    letterhead_img = MIMEImage(img_data)
+    letterhead_img.add_header('Content-ID', '<letterhead>')
+    letterhead_img.add_header('Content-Disposition', 'inline', filename='letterhead.png')
+    return letterhead_img
+
+def preload_email_templates():
+    """Load and validate all email assets at startup so problems show up in the boot log"""
+    for name in EMAIL_TEMPLATE_FIELDS:
+        try:
+            get_email_template(name)
+        except Exception as e:
+            logger.error(f"Email template {name} failed to load: {str(e)}")
+    get_letterhead_attachment()
+
 def send_raffle_receipt_email(payer_email, payer_name, amount, raffle_quantity, transaction_id):
     """Send raffle purchase confirmation email (non-tax-deductible)"""
     if not payer_email:
@@ -258,18 +1822,7 @@ def send_raffle_receipt_email(payer_email, payer_name, amount, raffle_quantity,
     
     # Load the raffle HTML template
     try:
-        local_template_path = os.path.join(os.path.dirname(__file__), '..', 'local-config', 'templates', 'raffle_purchase_email.html')
-        template_path = os.path.join(os.path.dirname(__file__), '..', 'templates', 'raffle_purchase_email.html')
-        
-        # Use local-config template if it exists, otherwise use the generic one
-        if os.path.exists(local_template_path):
-            template_path = local_template_path
-            logger.info("Using local-config raffle email template")
-        else:
-            logger.info("Using generic raffle email template")
-            
-        with open(template_path, 'r', encoding='utf-8') as f:
-            html_template = f.read()
+        html_template = get_email_template('raffle_purchase_email.html')
         
         # Replace template variables
         html_body = html_template.format(
@@ -281,22 +1834,9 @@ def send_raffle_receipt_email(payer_email, payer_name, amount, raffle_quantity,
             raffle_quantity=raffle_quantity
         )
         
-        # Prepare letterhead image attachment - prefer local-config version
-        attachments = []
-        local_letterhead_path = os.path.join(os.path.dirname(__file__), '..', 'local-config', 'templates', 'SWCA-letterhead-v3-1024x224.png')
-        letterhead_path = local_letterhead_path if os.path.exists(local_letterhead_path) else None
-        
-        if letterhead_path and os.path.exists(letterhead_path):
-            with open(letterhead_path, 'rb') as f:
-                img_data = f.read()
-            
-            letterhead_img = MIMEImage(img_data)
-            letterhead_img.add_header('Content-ID', '<letterhead>')
-            letterhead_img.add_header('Content-Disposition', 'inline', filename='letterhead.png')
-            attachments.append(letterhead_img)
-            logger.info("Using local-config letterhead image for raffle email")
-        else:
-            logger.info("No letterhead image found for raffle email, proceeding without embedded image")
+        # Letterhead image comes from local-config only
+        letterhead_img = get_letterhead_attachment()
+        attachments = [letterhead_img] if letterhead_img else []
         
         return send_email(payer_email, subject, html_body, is_html=True, attachments=attachments)
         
@@ -342,23 +1882,13 @@ def send_receipt_email(payer_email, payer_name, amount, payment_type, transactio
     
     subject = f"Thank you for your {payment_type} - {ORGANIZATION_NAME}"
     
-    # Load the HTML template - prefer local-config version if available
+    # Load the cached HTML template - prefers local-config version if available
     try:
-        local_template_path = os.path.join(os.path.dirname(__file__), '..', 'local-config', 'templates', 'donor_acknowledgment_email.html')
-        template_path = os.path.join(os.path.dirname(__file__), '..', 'templates', 'donor_acknowledgment_email.html')
-        
-        # Use local-config template if it exists, otherwise use the generic one
-        if os.path.exists(local_template_path):
-            template_path = local_template_path
-            logger.info("Using local-config email template")
-        else:
-            logger.info("Using generic email template")
-            
-        with open(template_path, 'r', encoding='utf-8') as f:
-            html_template = f.read()
+        html_template = get_email_template('donor_acknowledgment_email.html')
         
         # Prepare template variables based on payment type
-        is_membership = payment_type.lower() in ['individual membership', 'household membership']
+        # Cart receipts combine types, e.g. 'household membership and donation'
+        is_membership = any(m in payment_type.lower() for m in ['individual membership', 'household membership'])
         
         # Create membership-specific message
         membership_message = ""
@@ -390,29 +1920,16 @@ def send_receipt_email(payer_email, payer_name, amount, payment_type, transactio
             goods_services_statement=goods_services_statement
         )
         
-        # Prepare letterhead image attachment - prefer local-config version
-        attachments = []
-        local_letterhead_path = os.path.join(os.path.dirname(__file__), '..', 'local-config', 'templates', 'SWCA-letterhead-v3-1024x224.png')
-        letterhead_path = local_letterhead_path if os.path.exists(local_letterhead_path) else None
-        
-        if letterhead_path and os.path.exists(letterhead_path):
-            with open(letterhead_path, 'rb') as f:
-                img_data = f.read()
-            
-            letterhead_img = MIMEImage(img_data)
-            letterhead_img.add_header('Content-ID', '<letterhead>')
-            letterhead_img.add_header('Content-Disposition', 'inline', filename='letterhead.png')
-            attachments.append(letterhead_img)
-            logger.info("Using local-config letterhead image")
-        else:
-            logger.info("No letterhead image found, proceeding without embedded image")
+        # Letterhead image comes from local-config only
+        letterhead_img = get_letterhead_attachment()
+        attachments = [letterhead_img] if letterhead_img else []
         
         return send_email(payer_email, subject, html_body, is_html=True, attachments=attachments)
         
     except Exception as e:
         logger.error(f"Error loading email template: {str(e)}")
         # Fallback to simple email if template loading fails
-        is_membership_fallback = payment_type.lower() in ['individual membership', 'household membership']
+        is_membership_fallback = any(m in payment_type.lower() for m in ['individual membership', 'household membership'])
         membership_request = ""
         if is_membership_fallback:
             membership_request = f"""
@@ -442,13 +1959,14 @@ def send_receipt_email(payer_email, payer_name, amount, payment_type, transactio
         """
         return send_email(payer_email, subject, fallback_body, is_html=True)
 
+# Stripe processing fee: 2.9% + $0.30
+PROCESSING_FEE_RATE = 0.029
+PROCESSING_FEE_FIXED = 30  # 30 cents in cents
+
 def calculate_fee_amount(base_amount_cents):
     """Calculate Stripe processing fee (2.9% + $0.30)"""
-    fee_percentage = 0.029
-    fee_fixed = 30  # 30 cents in cents
-    
     # Calculate total fee
-    fee = round(base_amount_cents * fee_percentage) + fee_fixed
+    fee = round(base_amount_cents * PROCESSING_FEE_RATE) + PROCESSING_FEE_FIXED
     return fee
 
 def calculate_total_with_fees(base_amount_cents):
@@ -456,8 +1974,31 @@ def calculate_total_with_fees(base_amount_cents):
     fee = calculate_fee_amount(base_amount_cents)
     return base_amount_cents + fee
 
-def send_notification_email(payer_name, payer_email, amount, payment_type, transaction_id, metadata=None):
-    """Send notification email to the organization"""
+def build_pricing_manifest():
+    """Prices and fee formula for client-side previews, as (version, JSON); the version is a content hash"""
+    manifest = {
+        'currency': 'usd',
+        'memberships': {
+            'individual': INDIVIDUAL_MEMBERSHIP_AMOUNT,
+            'household': HOUSEHOLD_MEMBERSHIP_AMOUNT,
+        },
+        'raffle': {
+            'price_per_ticket': RAFFLE_PRICE_PER_TICKET,
+            'custom_min_tickets': RAFFLE_CUSTOM_MIN_TICKETS,
+            'packages': [{'tickets': tickets, 'amount': amount} for tickets, amount in RAFFLE_PACKAGES],
+        },
+        # fee = round_half_even(amount * rate) + fixed, matching calculate_fee_amount
+        'fees': {'rate': PROCESSING_FEE_RATE, 'fixed': PROCESSING_FEE_FIXED, 'rounding': 'half_even'},
+    }
+    version = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:12]
+    return version, json.dumps({'version': version, **manifest})
+
+# Built once: every input comes from the environment, so it only changes on restart
+PRICING_VERSION, PRICING_MANIFEST_JSON = build_pricing_manifest()
+
+def send_notification_email(payer_name, payer_email, amount, payment_type, transaction_id, metadata=None,
+                            recipients=None):
+    """Send notification email to the organization (recipients defaults to NOTIFICATION_EMAIL)"""
     amount_dollars = amount / 100
     date_str = datetime.now().strftime('%B %d, %Y at %I:%M %p')
     
@@ -468,6 +2009,14 @@ def send_notification_email(payer_name, payer_email, amount, payment_type, trans
     if payment_type == 'raffle' and metadata and 'raffle_quantity' in metadata:
         raffle_quantity = metadata.get('raffle_quantity')
         raffle_info = f"\n- RAFFLE TICKETS: {raffle_quantity} tickets purchased\n- PRICE PER TICKET: $0.80\n- RAFFLE FUNDS: This payment was for raffle tickets (not tax-deductible)"
+    elif metadata and 'items' in metadata:
+        # Cart: itemize, with any covered fee shared out across the lines
+        lines = json.loads(metadata['items'])
+        raffle_info = "\n\nITEMS:" + ''.join(
+            f"\n- {cart_line_label(line)}: ${(line['amount'] + line.get('fee', 0)) / 100:.2f}"
+            f"{' (not tax-deductible)' if line['type'] == 'raffle' else ''}"
+            for line in lines
+        )
     
     body = f"""
 New payment received through the POS system:
@@ -486,34 +2035,219 @@ This payment was processed through Stripe Terminal at your community event.
 {ORGANIZATION_NAME} POS System
     """
     
-    # Send to multiple notification recipients
-    notification_emails = []
-    if NOTIFICATION_EMAIL:
-        # Split by comma and clean whitespace
-        notification_emails = [email.strip() for email in NOTIFICATION_EMAIL.split(',')]
+    if recipients is None:
+        recipients = notification_recipients()
+    if not recipients:
+        return False
+    
+    # One message to every recipient costs a single send, however long the list
+    if len(recipients) > 1:
+        try:
+            if send_email(', '.join(recipients), subject, body, raise_rejections=True):
+                logger.info(f"Notification email sent to {len(recipients)} recipients in one message")
+                return True
+            # Outage or lost response: the outbox retries the same single message, never one per recipient
+            return False
+        except RecipientsRejected as e:
+            if e.delivered:
+                raise PartialDelivery({'recipients': e.refused}, f"notification refused for {', '.join(e.refused)}")
+            if len(e.refused) >= len(recipients):
+                return False
+    
+    # Rejected as a whole (e.g. one malformed address) or a single recipient: send individually in parallel
+    results = dict(zip(recipients, get_notification_pool().map(lambda address: send_email(address, subject, body), recipients)))
+    for address, success in results.items():
+        logger.info(f"Notification email to {address}: {'sent' if success else 'failed'}")
+    failed = [address for address, success in results.items() if not success]
+    if failed and len(failed) < len(recipients):
+        raise PartialDelivery({'recipients': failed}, f"notification failed for {', '.join(failed)}")
+    return not failed
+
+def notification_recipients():
+    """NOTIFICATION_EMAIL split into addresses"""
+    return [address.strip() for address in (NOTIFICATION_EMAIL or '').split(',') if address.strip()]
+
+# Threads for per-recipient notification sends; kept for the process so each reuses its Gmail client
+NOTIFICATION_FANOUT_WORKERS = 4
+_notification_pool = None
+_notification_pool_lock = threading.Lock()
+
+def get_notification_pool():
+    global _notification_pool
+    with _notification_pool_lock:
+        if _notification_pool is None:
+            _notification_pool = ThreadPoolExecutor(max_workers=NOTIFICATION_FANOUT_WORKERS,
+                                                    thread_name_prefix='notification-send')
+        return _notification_pool
+
+class PartialDelivery(Exception):
+    """Raised by an email job handler when only some recipients got the message
+    
+    retry_payload holds the payload changes (e.g. the remaining recipients) for the job's next attempt.
+    """
+    def __init__(self, retry_payload, message):
+        super().__init__(message)
+        self.retry_payload = retry_payload
+
+# Email outbox: payment handlers enqueue, background workers send with retry/backoff
+EMAIL_JOB_HANDLERS = {
+    'receipt': send_receipt_email,
+    'notification': send_notification_email,
+}
+_outbox_wakeup = threading.Event()
+_email_workers_lock = threading.Lock()
+_email_workers = []
+email_workers_enabled = True  # Off in CLI commands, which leave sending to the web process
+email_send_latencies = deque(maxlen=200)  # (seconds, succeeded) for recent send attempts
+
+def start_email_workers():
+    """Start the outbox worker pool once per process"""
+    if _email_workers:
+        return
+    with _email_workers_lock:
+        if _email_workers:
+            return
+        for i in range(max(EMAIL_WORKERS, 1)):
+            worker = threading.Thread(target=email_worker, name=f"email-worker-{i}", daemon=True)
+            worker.start()
+            _email_workers.append(worker)
+        logger.info(f"Started {len(_email_workers)} email outbox workers")
+
+def insert_email_job(conn, kind, payload):
+    """Add an email job to the outbox, inside the caller's transaction if one is open"""
+    now = time.time()
+    conn.execute(
+        "INSERT INTO email_outbox (kind, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+        (kind, json.dumps(payload), now, now)
+    )
+
+def wake_email_workers():
+    """Make sure the worker pool is running and let it know new jobs are waiting"""
+    if not email_workers_enabled:
+        return
+    start_email_workers()
+    _outbox_wakeup.set()
+
+def claim_email_job():
+    """Atomically claim the next due outbox job, or return None"""
+    conn = get_db()
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        job = conn.execute(
+            """SELECT * FROM email_outbox
+               WHERE (status = 'pending' AND next_attempt_at <= ?)
+                  OR (status = 'sending' AND claimed_at < ?)
+               ORDER BY next_attempt_at LIMIT 1""",
+            (now, now - EMAIL_SEND_TIMEOUT)
+        ).fetchone()
+        if job:
+            conn.execute(
+                "UPDATE email_outbox SET status = 'sending', attempts = attempts + 1, claimed_at = ? WHERE id = ?",
+                (now, job['id'])
+            )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job
+
+def run_email_job(job):
+    """Send one outbox job and record the outcome, rescheduling or dead-lettering failures"""
+    attempts = job['attempts'] + 1
+    error = None
+    payload = json.loads(job['payload'])
+    started = time.monotonic()
+    try:
+        handler = EMAIL_JOB_HANDLERS[job['kind']]
+        sent = handler(**payload)
+        if not sent:
+            error = 'send returned False'
+    except PartialDelivery as e:
+        # Retries go only to the recipients that didn't get it
+        error = str(e)
+        payload.update(e.retry_payload)
+    except Exception as e:
+        error = str(e)
+    elapsed = time.monotonic() - started
+    email_send_latencies.append((elapsed, error is None))
+    
+    conn = get_db()
+    if error is None:
+        conn.execute("UPDATE email_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+                     (time.time(), job['id']))
+        logger.info(f"Outbox {job['kind']} email {job['id']} sent in {elapsed:.2f}s")
+    elif attempts >= EMAIL_MAX_ATTEMPTS:
+        conn.execute("UPDATE email_outbox SET status = 'dead', last_error = ?, payload = ? WHERE id = ?",
+                     (error, json.dumps(payload), job['id']))
+        logger.error(f"Outbox {job['kind']} email {job['id']} dead-lettered after {attempts} attempts: {error}")
+    else:
+        # Exponential backoff with jitter so retries from a Gmail outage don't arrive in lockstep
+        delay = min(EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1), EMAIL_RETRY_MAX_SECONDS)
+        delay *= random.uniform(0.5, 1.5)
+        conn.execute("UPDATE email_outbox SET status = 'pending', next_attempt_at = ?, last_error = ?, payload = ? WHERE id = ?",
+                     (time.time() + delay, error, json.dumps(payload), job['id']))
+        logger.warning(f"Outbox {job['kind']} email {job['id']} failed (attempt {attempts}), retrying in {delay:.0f}s: {error}")
+
+def email_worker():
+    """Drain the email outbox until the process exits"""
+    while True:
+        try:
+            _outbox_wakeup.clear()
+            job = claim_email_job()
+            if job is None:
+                _outbox_wakeup.wait(EMAIL_OUTBOX_POLL_INTERVAL)
+                continue
+            run_email_job(job)
+        except Exception as e:
+            logger.error(f"Email worker error: {str(e)}")
+            time.sleep(EMAIL_OUTBOX_POLL_INTERVAL)
+
+def get_email_outbox_stats():
+    """Summarize outbox depth and recent send latency"""
+    conn = get_db()
+    counts = {row['status']: row['count'] for row in conn.execute(
+        "SELECT status, COUNT(*) AS count FROM email_outbox GROUP BY status")}
+    oldest = conn.execute(
+        "SELECT MIN(created_at) FROM email_outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+    dead = conn.execute(
+        "SELECT id, kind, attempts, created_at, last_error FROM email_outbox WHERE status = 'dead' ORDER BY id DESC LIMIT 20"
+    ).fetchall()
     
-    # Send email to each recipient
-    success_count = 0
-    for email in notification_emails:
-        if email:  # Skip empty emails
-            success = send_email(email, subject, body)
-            if success:
-                success_count += 1
-            logger.info(f"Notification email to {email}: {'sent' if success else 'failed'}")
+    latencies = sorted(elapsed for elapsed, _ in list(email_send_latencies))
+    latency = {'count': len(latencies)}
+    if latencies:
+        latency.update({
+            'avg_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+            'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+            'max_ms': round(latencies[-1] * 1000, 1),
+        })
     
-    return success_count > 0  # Return True if at least one email was sent successfully
+    return {
+        'depth': counts.get('pending', 0) + counts.get('sending', 0),
+        'by_status': counts,
+        'oldest_pending_age_seconds': round(time.time() - oldest, 1) if oldest else 0,
+        'send_latency': latency,
+        'dead_letters': [dict(row) for row in dead],
+        'workers': len(_email_workers),
+    }
+
+preload_email_templates()
 
 @app.route('/')
 def index():
-    return render_template('index.html', 
+    # Fill the pool while the tablet is still choosing what to pay for
+    start_payment_intent_pool()
+    return rendered_page_response('index.html', 
                          organization_name=ORGANIZATION_NAME,
                          organization_logo=ORGANIZATION_LOGO,
                          organization_website=ORGANIZATION_WEBSITE,
-                         raffle_enabled=RAFFLE_ENABLED)
+                         raffle_enabled=RAFFLE_ENABLED,
+                         pricing_version=PRICING_VERSION)
 
 @app.route('/admin-readers')
 def admin_readers():
-    return render_template('admin_readers.html', 
+    return rendered_page_response('admin_readers.html', 
                          organization_name=ORGANIZATION_NAME,
                          organization_logo=ORGANIZATION_LOGO,
                          organization_website=ORGANIZATION_WEBSITE,
@@ -532,8 +2266,122 @@ def create_connection_token():
 
 @app.route('/health')
 def health():
+    if 'first_health' not in startup_timings:
+        startup_timings['first_health'] = time.monotonic() - APP_IMPORT_STARTED
+        logger.info(f"First /health answered {startup_timings['first_health']:.2f}s after app import started")
     return jsonify({'status': 'healthy'})
 
+@app.route('/stats')
+@require_admin_token
+def stats():
+    """Operational counters for background queues and caches; dead letters can name recipients, so admin only"""
+    try:
+        return jsonify({
+            'email_outbox': get_email_outbox_stats(),
+            'reader_registry': get_reader_registry_stats(),
+            'reader_scheduler': get_reader_scheduler_stats(),
+            'payment_intent_cache': get_payment_intent_cache_stats(),
+            'stripe_calls': get_stripe_call_stats(),
+            'payment_intent_pool': get_payment_intent_pool_stats(),
+        })
+    except Exception as e:
+        logger.error(f"Error collecting stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: latency histograms plus queue and cache gauges"""
+    outbox = get_email_outbox_stats()
+    cache = get_payment_intent_cache_stats()
+    scheduler = get_reader_scheduler_stats()
+    sampled = [
+        ('pos_email_outbox_depth', 'gauge', 'Emails waiting to be sent', [({}, outbox['depth'])]),
+        ('pos_email_outbox_oldest_pending_age_seconds', 'gauge', 'Age of the oldest unsent email',
+         [({}, outbox['oldest_pending_age_seconds'])]),
+        ('pos_email_outbox_dead_letters', 'gauge', 'Emails that exhausted their retries',
+         [({}, outbox['by_status'].get('dead', 0))]),
+        ('pos_payment_intent_cache_lookups_total', 'counter', 'PaymentIntent cache lookups by result',
+         [({'result': result}, cache[result]) for result in ('hits', 'misses', 'coalesced')]),
+        ('pos_payment_intent_cache_entries', 'gauge', 'PaymentIntents held in the cache', [({}, cache['cached'])]),
+        ('pos_readers', 'gauge', 'Readers at this location in the registry',
+         [({}, get_reader_registry_stats()['readers'])]),
+        ('pos_readers_busy', 'gauge', 'Readers leased to a payment', [({}, len(scheduler['busy_readers']))]),
+        ('pos_reader_queue_length', 'gauge', 'Checkouts waiting for a reader', [({}, scheduler['queue_length'])]),
+        ('pos_transaction_log_queue_depth', 'gauge', 'Transaction rows waiting to be written',
+         [({}, _transaction_queue.qsize())]),
+        ('pos_startup_seconds', 'gauge', 'Cold-start phase durations for this process',
+         [({'phase': phase}, round(seconds, 4)) for phase, seconds in sorted(startup_timings.items())]),
+    ]
+    return Response(render_metrics(sampled), mimetype='text/plain; version=0.0.4')
+
+@app.route('/transactions/<month>.csv')
+@require_admin_token
+def export_transaction_month(month):
+    """Monthly ledger in the original CSV layout, whichever backend stores it"""
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        return jsonify({'error': 'Month must be YYYY-MM'}), 400
+    
+    rows = iter_transaction_rows(f"{month}-01", f"{month}-31")
+    return Response(
+        stream_transaction_csv(rows), mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="transactions_{month}.csv"'}
+    )
+
+@app.route('/export/transactions')
+@require_admin_token
+def export_transactions():
+    """Stream ledger rows for a date range as CSV, optionally gzipped, with column and status filters"""
+    start = request.args.get('start')
+    end = request.args.get('end')
+    try:
+        for value in (start, end):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'start and end must be YYYY-MM-DD'}), 400
+    
+    columns = TRANSACTION_FIELDNAMES
+    if request.args.get('columns'):
+        columns = [c.strip() for c in request.args['columns'].split(',') if c.strip()]
+        unknown = [c for c in columns if c not in TRANSACTION_FIELDNAMES]
+        if unknown or not columns:
+            return jsonify({'error': f"Unknown columns: {', '.join(unknown)}", 'columns': TRANSACTION_FIELDNAMES}), 400
+    
+    statuses = None
+    if request.args.get('status'):
+        statuses = {s.strip() for s in request.args['status'].split(',') if s.strip()}
+    
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    filename = f"transactions_{start or 'all'}_{end or 'now'}.csv" + ('.gz' if compress else '')
+    
+    rows = iter_transaction_rows(start, end, statuses)
+    return Response(
+        stream_transaction_csv(rows, columns, compress),
+        mimetype='application/gzip' if compress else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@app.route('/reports')
+@require_admin_token
+def reports():
+    """Succeeded-payment totals over an optional start/end date range (YYYY-MM-DD)"""
+    start = request.args.get('start')
+    end = request.args.get('end')
+    try:
+        for value in (start, end):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'start and end must be YYYY-MM-DD'}), 400
+    
+    try:
+        return jsonify(build_report(start, end))
+    except Exception as e:
+        logger.error(f"Error building report: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/debug-env')
 def debug_env():
     """Debug endpoint to check environment variables"""
@@ -545,6 +2393,18 @@ def debug_env():
     }
     return jsonify(env_info)
 
+@app.route('/pricing')
+def pricing():
+    """Pricing manifest for fee previews; checkout still prices every payment on the server"""
+    response = Response(PRICING_MANIFEST_JSON, mimetype='application/json')
+    response.set_etag(PRICING_VERSION)
+    if request.args.get('v') == PRICING_VERSION:
+        # The page asks for the version it was rendered with, so this URL's content never changes
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    return response.make_conditional(request)
+
 @app.route('/calculate-fees', methods=['POST'])
 def calculate_fees():
     try:
@@ -575,9 +2435,12 @@ def calculate_fees():
         elif payment_type == 'raffle':
             if not raffle_quantity or raffle_quantity <= 0:
                 return jsonify({'error': 'Invalid raffle ticket quantity'}), 400
-            if not amount or amount <= 0:
-                return jsonify({'error': 'Invalid raffle package amount'}), 400
-            base_amount = int(amount * 100)  # Convert package price to cents
+            try:
+                base_amount = raffle_price(int(raffle_quantity))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if amount is not None and round(amount * 100) != base_amount:
+                return jsonify({'error': 'Raffle amount does not match the ticket price'}), 400
         else:
             return jsonify({'error': 'Invalid payment type'}), 400
         
@@ -597,19 +2460,17 @@ def calculate_fees():
         logger.error(f"Error calculating fees: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/create-payment-intent', methods=['POST'])
-def create_payment_intent():
+MAX_CART_ITEMS = 10
+
+def price_cart_item(item, payer_name):
+    """Validate one cart item and return its line: type, base amount in cents and description; raises ValueError"""
+    payment_type = item.get('payment_type')
+    membership_type = item.get('membership_type')
+    amount = item.get('amount')
+    additional_donation = item.get('additional_donation') or 0
+    raffle_quantity = item.get('raffle_quantity') or 0
+    
     try:
-        data = request.json
-        payment_type = data.get('payment_type')
-        membership_type = data.get('membership_type')
-        amount = data.get('amount')
-        payer_name = data.get('payer_name', '')
-        payer_email = data.get('payer_email', '')
-        cover_fees = data.get('cover_fees', False)
-        additional_donation = data.get('additional_donation', 0)
-        raffle_quantity = data.get('raffle_quantity', 0)
-        
         # Determine base amount
         if payment_type == 'membership':
             if membership_type == 'individual':
@@ -619,54 +2480,195 @@ def create_payment_intent():
                 base_amount = HOUSEHOLD_MEMBERSHIP_AMOUNT
                 description = f"Household membership payment from {payer_name}"
             else:
-                return jsonify({'error': 'Invalid membership type'}), 400
-                
+                raise ValueError('Invalid membership type')
+            
             # Add additional donation if provided
-            if additional_donation and additional_donation > 0:
+            additional_donation = float(additional_donation)
+            if additional_donation < 0:
+                raise ValueError('Invalid additional donation amount')
+            if additional_donation > 0:
                 base_amount += int(additional_donation * 100)  # Convert to cents
                 description += f" + ${additional_donation:.2f} additional donation"
+            return {'type': payment_type, 'amount': base_amount, 'membership_type': membership_type, 'description': description}
                 
         elif payment_type == 'raffle':
-            base_amount = int(amount)  # Amount is already in cents from frontend
+            raffle_quantity = int(raffle_quantity)
+            if raffle_quantity <= 0:
+                raise ValueError('Invalid raffle ticket quantity')
+            # Priced here; the page's amount (cents) is only accepted when it agrees
+            base_amount = raffle_price(raffle_quantity)
+            if amount is not None and int(amount) != base_amount:
+                raise ValueError('Raffle amount does not match the ticket price')
             description = f"Raffle tickets purchase from {payer_name} - {raffle_quantity} tickets"
+            return {'type': payment_type, 'amount': base_amount, 'quantity': raffle_quantity, 'description': description}
+        elif payment_type == 'donation':
+            base_amount = int(amount)  # Cents
+            if base_amount <= 0:
+                raise ValueError('Invalid donation amount')
+            return {'type': payment_type, 'amount': base_amount, 'description': f"Donation from {payer_name}"}
         else:
-            base_amount = amount
-            description = f"Donation from {payer_name}"
-        
-        # Calculate final amount with fees if requested
-        if cover_fees:
-            final_amount = calculate_total_with_fees(base_amount)
-            fee_amount = calculate_fee_amount(base_amount)
-            description += f" (includes ${fee_amount/100:.2f} processing fee)"
-        else:
-            final_amount = base_amount
-        
-        metadata = {
-            'payment_type': payment_type,
-            'payer_name': payer_name,
-            'base_amount': str(base_amount),
-            'cover_fees': str(cover_fees)
-        }
-        
-        if cover_fees:
-            metadata['fee_amount'] = str(calculate_fee_amount(base_amount))
-        
-        if payer_email:
-            metadata['payer_email'] = payer_email
-            
-        if payment_type == 'raffle':
-            metadata['raffle_quantity'] = str(raffle_quantity)
-        
+            raise ValueError('Invalid payment type')
+    except TypeError:
+        raise ValueError('Invalid amount')
+
+def cart_line_label(line):
+    """Short human-readable name for a cart line, e.g. '12 raffle tickets'"""
+    if line['type'] == 'membership':
+        return f"{line.get('membership_type', '').title()} membership".strip()
+    if line['type'] == 'raffle':
+        return f"{line.get('quantity', 0)} raffle tickets"
+    return line['type'].title()
+
+def allocate_fee(lines, fee):
+    """Split a covered fee across lines in proportion to their amounts, in whole cents that add up to the fee"""
+    total = sum(line['amount'] for line in lines)
+    shares = [fee * line['amount'] // total for line in lines]
+    # Hand leftover cents to the lines with the largest remainders
+    by_remainder = sorted(range(len(lines)), key=lambda i: fee * lines[i]['amount'] % total, reverse=True)
+    for i in by_remainder[:fee - sum(shares)]:
+        shares[i] += 1
+    for line, share in zip(lines, shares):
+        line['fee'] = share
+
+def build_checkout(data):
+    """Validate a checkout request and return (final_amount, description, metadata); raises ValueError
+    
+    The request is either one item (payment_type and its fields at the top level) or a cart
+    under 'items'. A cart becomes one PaymentIntent whose 'items' metadata lists each line.
+    """
+    payer_name = data.get('payer_name', '')
+    payer_email = data.get('payer_email', '')
+    cover_fees = bool(data.get('cover_fees', False))
+    
+    items = data.get('items') or [data]
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ValueError('Invalid cart')
+    if len(items) > MAX_CART_ITEMS:
+        raise ValueError(f"A cart can hold at most {MAX_CART_ITEMS} items")
+    lines = [price_cart_item(item, payer_name) for item in items]
+    
+    base_amount = sum(line['amount'] for line in lines)
+    if len(lines) == 1:
+        payment_type = lines[0]['type']
+        description = lines[0]['description']
+    else:
+        payment_type = 'cart'
+        description = f"POS cart from {payer_name}: {', '.join(cart_line_label(line) for line in lines)}"
+    
+    # Calculate final amount with fees if requested; the fee covers the cart total
+    fee_amount = calculate_fee_amount(base_amount) if cover_fees else 0
+    final_amount = base_amount + fee_amount
+    if cover_fees:
+        description += f" (includes ${fee_amount/100:.2f} processing fee)"
+    
+    metadata = {
+        'payment_type': payment_type,
+        'payer_name': payer_name,
+        'base_amount': str(base_amount),
+        'cover_fees': str(cover_fees)
+    }
+    
+    if cover_fees:
+        metadata['fee_amount'] = str(fee_amount)
+    
+    if payer_email:
+        metadata['payer_email'] = payer_email
+    
+    raffle_quantity = sum(line.get('quantity', 0) for line in lines)
+    if raffle_quantity:
+        metadata['raffle_quantity'] = str(raffle_quantity)
+    
+    if payment_type == 'cart':
+        allocate_fee(lines, fee_amount)
+        metadata['items'] = json.dumps(
+            [{k: v for k, v in line.items() if k != 'description'} for line in lines], separators=(',', ':')
+        )
+        if len(metadata['items']) > 500:  # Stripe's limit for one metadata value
+            raise ValueError('Cart has too many items')
+    
+    return final_amount, description, metadata
+
+def open_payment_intent(final_amount, description, metadata, checkout_id):
+    """Claim a pooled PaymentIntent or create one, and record it in the state store"""
+    payment_type = metadata['payment_type']
+    start_payment_intent_pool()
+    payment_intent = find_checkout_payment_intent(checkout_id, final_amount)
+    if payment_intent:
+        logger.info(f"Reusing PaymentIntent {payment_intent.id} for resubmitted checkout {checkout_id}")
+        return payment_intent
+    
+    payment_intent = claim_pooled_payment_intent(final_amount, checkout_id, description, metadata)
+    if payment_intent:
+        logger.info(f"Claimed pooled PaymentIntent {payment_intent.id} for {payment_type} amount {final_amount}")
+    else:
         payment_intent = stripe.PaymentIntent.create(
             amount=final_amount,
             currency='usd',
             payment_method_types=['card_present'],
             capture_method='automatic',
             description=description,
-            metadata=metadata
+            metadata=metadata,
+            idempotency_key=f"pos-checkout-{checkout_id}" if checkout_id else None
         )
-        
+        # A resubmit after the pool refills must get this intent, not a pooled one
+        remember_checkout_payment_intent(checkout_id, payment_intent, final_amount)
         logger.info(f"Created PaymentIntent {payment_intent.id} for {payment_type} amount {final_amount}")
+    
+    record_payment_state(payment_intent.id, payment_intent.status, final_amount, metadata, created_at=time.time())
+    return payment_intent
+
+def dispatch_to_reader(payment_intent_id, session_id):
+    """Send a PaymentIntent to an idle reader; returns (body, status_code) for the JSON response"""
+    # Use the cached reader list, re-listing from Stripe if the cache has none
+    readers = get_location_readers()
+    if not readers:
+        readers = get_location_readers(force_refresh=True)
+    if not readers:
+        return {'error': 'No card readers available. Please set up a reader using the admin interface.'}, 400
+    
+    reader_id, queue_position = acquire_reader(payment_intent_id, session_id, readers)
+    if reader_id is None:
+        logger.info(f"All readers busy - {payment_intent_id} queued at position {queue_position}")
+        return {
+            'status': 'queued',
+            'payment_intent_id': payment_intent_id,
+            'queue_position': queue_position
+        }, 202
+    
+    try:
+        stripe.terminal.Reader.process_payment_intent(
+            reader_id,
+            payment_intent=payment_intent_id
+        )
+    except stripe.error.InvalidRequestError as e:
+        release_reader(payment_intent_id)
+        if e.code == 'terminal_reader_busy':
+            # Busy with something we didn't schedule; keep it off the rotation briefly
+            hold_reader(reader_id, 15)
+        else:
+            # The reader may have been deleted or moved; re-list before the next attempt
+            invalidate_reader_registry()
+        raise
+    except Exception:
+        release_reader(payment_intent_id)
+        raise
+    
+    logger.info(f"Processing payment {payment_intent_id} on reader {reader_id}")
+    return {
+        'status': 'processing',
+        'payment_intent_id': payment_intent_id
+    }, 200
+
+@app.route('/create-payment-intent', methods=['POST'])
+def create_payment_intent():
+    try:
+        data = request.json
+        try:
+            final_amount, description, metadata = build_checkout(data)
+            # Generated once per checkout attempt by the page, so a resubmitted request can't create a second intent
+            payment_intent = open_payment_intent(final_amount, description, metadata, data.get('checkout_id'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         return jsonify({
             'client_secret': payment_intent.client_secret,
@@ -677,6 +2679,33 @@ def create_payment_intent():
         logger.error(f"Error creating payment intent: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/checkout', methods=['POST'])
+def checkout():
+    """Validate, price, create and dispatch a payment in one request"""
+    try:
+        data = request.json
+        try:
+            final_amount, description, metadata = build_checkout(data)
+            payment_intent = open_payment_intent(final_amount, description, metadata, data.get('checkout_id'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error creating payment intent: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    
+    channels = {
+        'amount': final_amount,
+        'status_url': url_for('payment_status_stream', payment_intent_id=payment_intent.id),
+        'poll_url': url_for('payment_status', payment_intent_id=payment_intent.id),
+    }
+    try:
+        body, status_code = dispatch_to_reader(payment_intent.id, data.get('session_id'))
+    except Exception as e:
+        # The intent exists, so the page can retry the reader step through /process-payment
+        logger.error(f"Error processing payment: {str(e)}")
+        return jsonify({'error': str(e), 'payment_intent_id': payment_intent.id, **channels}), 500
+    return jsonify({**body, **channels}), status_code
+
 @app.route('/register-reader', methods=['POST'])
 def register_reader():
     try:
@@ -692,6 +2721,7 @@ def register_reader():
         )
         
         logger.info(f"Successfully registered reader {reader.id} with code {registration_code}")
+        invalidate_reader_registry()
         
         return jsonify({
             'reader': {
@@ -711,29 +2741,27 @@ def discover_readers():
         logger.info(f"Searching for readers in location: {STRIPE_LOCATION_ID}")
         logger.info(f"Using API key: {stripe.api_key[:12]}...")  # First 12 chars only
         
-        # First, let's try to list all readers (no location filter) to debug
-        all_readers = stripe.terminal.Reader.list()
-        logger.info(f"Total readers in account: {len(all_readers.data)}")
+        # One Stripe call lists the whole account; readers in our location are filtered from it
+        readers = get_location_readers(force_refresh=True)
+        all_readers = get_all_readers()
+        logger.info(f"Total readers in account: {len(all_readers)}")
         
-        for reader in all_readers.data:
+        for reader in all_readers:
             logger.info(f"Reader {reader.id}: location={reader.location}, status={reader.status}, type={reader.device_type}")
         
-        # Now list readers in the specific location
-        readers = stripe.terminal.Reader.list(
-            location=STRIPE_LOCATION_ID
-        )
-        
-        logger.info(f"Found {len(readers.data)} readers in location {STRIPE_LOCATION_ID}")
+        logger.info(f"Found {len(readers)} readers in location {STRIPE_LOCATION_ID}")
         
+        busy_reader_ids = get_busy_reader_ids()
         reader_list = []
-        for reader in readers.data:
+        for reader in readers:
             reader_info = {
                 'id': reader.id,
                 'label': reader.label or 'Stripe Reader',
                 'status': reader.status,
                 'device_type': reader.device_type,
                 'serial_number': reader.serial_number[-4:] if reader.serial_number else 'N/A',  # Last 4 digits only
-                'location': reader.location
+                'location': reader.location,
+                'busy': reader.id in busy_reader_ids
             }
             reader_list.append(reader_info)
             logger.info(f"Reader found: {reader.label} ({reader.device_type}) - Status: {reader.status}")
@@ -741,8 +2769,8 @@ def discover_readers():
         return jsonify({
             'readers': reader_list,
             'location_id': STRIPE_LOCATION_ID,
-            'total_readers_in_account': len(all_readers.data),
-            'debug_all_readers': [{'id': r.id, 'location': r.location, 'status': r.status} for r in all_readers.data]
+            'total_readers_in_account': len(all_readers),
+            'debug_all_readers': [{'id': r.id, 'location': r.location, 'status': r.status} for r in all_readers]
         })
         
     except Exception as e:
@@ -754,109 +2782,304 @@ def process_payment():
     try:
         data = request.json
         payment_intent_id = data.get('payment_intent_id')
+        session_id = data.get('session_id')  # Identifies the tablet so it keeps using the same reader
         
         if not payment_intent_id:
             return jsonify({'error': 'Missing payment_intent_id'}), 400
         
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-        
-        # Get list of readers and use the first available one
-        readers = stripe.terminal.Reader.list(location=STRIPE_LOCATION_ID)
-        if not readers.data:
-            return jsonify({'error': 'No card readers available. Please set up a reader using the admin interface.'}), 400
-        
-        # Use the first available reader
-        reader_id = readers.data[0].id
-        
-        reader = stripe.terminal.Reader.process_payment_intent(
-            reader_id,
-            payment_intent=payment_intent_id
-        )
-        
-        logger.info(f"Processing payment {payment_intent_id} on reader {reader_id}")
-        
-        return jsonify({
-            'status': 'processing',
-            'payment_intent_id': payment_intent_id
-        })
+        # No retrieve first: Stripe rejects an unknown or already-settled intent on the reader call itself
+        body, status_code = dispatch_to_reader(payment_intent_id, session_id)
+        return jsonify(body), status_code
         
     except Exception as e:
         logger.error(f"Error processing payment: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def claim_side_effect(conn, payment_intent_id, effect):
+    """Atomically claim a post-payment side effect; only the first caller in any worker gets True"""
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO payment_side_effects (payment_intent_id, effect, claimed_at) VALUES (?, ?, ?)",
+        (payment_intent_id, effect, time.time())
+    )
+    return cursor.rowcount == 1
+
+def settle_payment(payment_intent_id, status, amount, metadata):
+    """Log a settled payment and queue its emails, each exactly once across workers and restarts"""
+    if metadata.get('emails_sent'):
+        # Settled before the local ledger existed; Stripe metadata already records its side effects
+        return
+    
+    payer_name = metadata.get('payer_name', 'Unknown')
+    payer_email = metadata.get('payer_email')
+    payment_type = metadata.get('payment_type', 'payment')
+    
+    email_jobs = []  # (side effect claimed, outbox job kind, payload)
+    if status == 'succeeded' and FROM_EMAIL:
+        if payer_email and 'items' in metadata:
+            email_jobs.extend(cart_receipt_jobs(payment_intent_id, payer_name, payer_email, json.loads(metadata['items'])))
+        elif payer_email:
+            raffle_quantity = None
+            if payment_type == 'raffle' and 'raffle_quantity' in metadata:
+                raffle_quantity = int(metadata.get('raffle_quantity', 0))
+            email_jobs.append(('receipt', 'receipt', {
+                'payer_email': payer_email, 'payer_name': payer_name, 'amount': amount,
+                'payment_type': payment_type, 'transaction_id': payment_intent_id, 'raffle_quantity': raffle_quantity
+            }))
+        if NOTIFICATION_EMAIL:
+            email_jobs.append(('notification', 'notification', {
+                'payer_name': payer_name, 'payer_email': payer_email, 'amount': amount,
+                'payment_type': payment_type, 'transaction_id': payment_intent_id, 'metadata': metadata
+            }))
+    elif status == 'succeeded':
+        logger.warning(f"FROM_EMAIL not configured - no emails queued for {payment_intent_id}")
+    
+    # Claims and outbox rows commit together, so a queued email is never lost or duplicated
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        log_claimed = claim_side_effect(conn, payment_intent_id, f"log_{status}")
+        queued = []
+        for effect, kind, payload in email_jobs:
+            if claim_side_effect(conn, payment_intent_id, effect):
+                insert_email_job(conn, kind, payload)
+                queued.append(effect)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    
+    if queued:
+        wake_email_workers()
+        logger.info(f"Queued {', '.join(queued)} email(s) for {payment_intent_id}")
+    
+    if log_claimed:
+        log_payment_lines(payment_intent_id, payer_name, payer_email, amount, payment_type, status, metadata)
+
+def cart_receipt_jobs(payment_intent_id, payer_name, payer_email, lines):
+    """Receipt jobs for a cart: one for the tax-deductible lines and a raffle confirmation for the rest"""
+    jobs = []
+    deductible = [line for line in lines if line['type'] != 'raffle']
+    raffle = [line for line in lines if line['type'] == 'raffle']
+    if deductible:
+        # e.g. 'household membership and donation'; receipts word themselves from this
+        labels = []
+        for line in deductible:
+            label = cart_line_label(line).lower() if line['type'] == 'membership' else line['type']
+            if label not in labels:
+                labels.append(label)
+        jobs.append(('receipt', 'receipt', {
+            'payer_email': payer_email, 'payer_name': payer_name,
+            'amount': sum(line['amount'] + line.get('fee', 0) for line in deductible),
+            'payment_type': ' and '.join(labels), 'transaction_id': payment_intent_id, 'raffle_quantity': None
+        }))
+    if raffle:
+        jobs.append(('raffle_receipt', 'receipt', {
+            'payer_email': payer_email, 'payer_name': payer_name,
+            'amount': sum(line['amount'] + line.get('fee', 0) for line in raffle),
+            'payment_type': 'raffle', 'transaction_id': payment_intent_id,
+            'raffle_quantity': sum(line['quantity'] for line in raffle)
+        }))
+    return jobs
+
+def log_payment_lines(payment_intent_id, payer_name, payer_email, amount, payment_type, status, metadata):
+    """Write one ledger row per cart line, each carrying its share of a covered fee, or one row otherwise"""
+    if 'items' not in metadata:
+        log_transaction(payment_intent_id, payer_name, payer_email, amount, payment_type, status, metadata)
+        return
+    
+    for line in json.loads(metadata['items']):
+        fee = line.get('fee', 0)
+        log_transaction(
+            payment_intent_id, payer_name, payer_email, line['amount'] + fee, line['type'], status,
+            {'cover_fees': metadata.get('cover_fees', 'False'), 'base_amount': str(line['amount']), 'fee_amount': str(fee)}
+        )
+
+def settle_payment_state(state):
+    """Run settle_payment for a final state unless this process already has"""
+    if state['status'] not in FINAL_PAYMENT_STATUSES or state['amount'] is None:
+        return
+    if 'payment_type' not in state['metadata']:
+        return  # Not a POS checkout, e.g. an unclaimed pooled intent being cancelled
+    if state.get('settled') == state['status']:
+        return
+    
+    try:
+        settle_payment(state['id'], state['status'], state['amount'], state['metadata'])
+        record_payment_state(state['id'], state['status'], settled=state['status'])
+        if state['status'] == 'succeeded' and state.get('created_at'):
+            observe_metric('pos_checkout_duration_seconds', time.time() - state['created_at'],
+                           payment_type=state['metadata'].get('payment_type', 'payment'))
+    except Exception as e:
+        # Left unsettled so the next status check or webhook tries again
+        logger.error(f"Error settling payment {state['id']}: {str(e)}")
+
+def resolve_payment_status(payment_intent_id):
+    """Return the current state of a payment, settling it once it reaches a final status"""
+    # Answer from the webhook-fed store and only ask Stripe when it is stale
+    state = get_payment_state(payment_intent_id)
+    if state is None:
+        state = refresh_payment_state(payment_intent_id)
+    
+    settle_payment_state(state)
+    return {'status': state['status'], 'amount': state['amount'], 'metadata': state['metadata']}
+
+def reconcile_payments(since, until=None, dry_run=False):
+    """Compare POS PaymentIntents in Stripe with the local ledger and backfill missing rows and receipts"""
+    # Load the local side in bulk: logged succeeded amounts and ledger claims
+    logged = {}
+    for row in iter_transaction_rows((since - timedelta(days=1)).strftime('%Y-%m-%d'), statuses={'succeeded'}):
+        logged[row['payment_intent_id']] = logged.get(row['payment_intent_id'], 0) + to_cents(row['amount_cents'])
+    claimed_logs = {row[0] for row in get_db().execute(
+        "SELECT payment_intent_id FROM payment_side_effects WHERE effect = 'log_succeeded' AND claimed_at >= ?",
+        ((since - timedelta(days=1)).timestamp(),)
+    )}
+    
+    created = {'gte': int(since.timestamp())}
+    if until:
+        created['lte'] = int(until.timestamp())
+    
+    summary = {'checked': 0, 'backfilled': [], 'amount_mismatch': [], 'not_succeeded_in_stripe': [],
+               'unlabeled_pool_payments': []}
+    for payment_intent in stripe.PaymentIntent.list(created=created, limit=100).auto_paging_iter():
+        metadata = dict(payment_intent.metadata or {})
+        if 'payment_type' not in metadata:
+            # A pooled intent whose checkout details never reached Stripe (patch failed or the process restarted):
+            # it can't be logged or receipted from here, so flag it for a manual entry
+            if (metadata.get('pos_pool') and payment_intent.status == 'succeeded'
+                    and payment_intent.id not in logged):
+                summary['unlabeled_pool_payments'].append({'id': payment_intent.id, 'amount': payment_intent.amount})
+            continue  # Not created by this POS
+        summary['checked'] += 1
+        
+        if payment_intent.status != 'succeeded':
+            if payment_intent.id in logged:
+                summary['not_succeeded_in_stripe'].append({'id': payment_intent.id, 'status': payment_intent.status})
+            continue
+        
+        if payment_intent.id in logged:
+            if logged[payment_intent.id] != payment_intent.amount:
+                summary['amount_mismatch'].append({
+                    'id': payment_intent.id, 'stripe_cents': payment_intent.amount, 'logged_cents': logged[payment_intent.id]
+                })
+            continue
+        
+        summary['backfilled'].append(payment_intent.id)
+        if dry_run:
+            continue
+        if metadata.get('emails_sent') or payment_intent.id in claimed_logs:
+            # Emails already went out; only the ledger row was lost
+            log_payment_lines(
+                payment_intent.id, metadata.get('payer_name', 'Unknown'), metadata.get('payer_email'),
+                payment_intent.amount, metadata.get('payment_type', 'payment'), 'succeeded', metadata
+            )
+        else:
+            settle_payment(payment_intent.id, 'succeeded', payment_intent.amount, metadata)
+    
+    flush_transaction_log()
+    return summary
+
+@app.cli.command('reconcile')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='Check PaymentIntents created on or after this date')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), help='Check PaymentIntents created before this date')
+@click.option('--days', default=7, show_default=True, help='Look back this many days when --since is not given')
+@click.option('--dry-run', is_flag=True, help='Report discrepancies without backfilling')
+def reconcile_command(since, until, days, dry_run):
+    """Backfill succeeded payments missing from the ledger and report discrepancies"""
+    global email_workers_enabled
+    # Queued receipts stay in the shared outbox; the web process's workers poll it and send them
+    email_workers_enabled = False
+    
+    load_stripe()
+    since = since or datetime.now() - timedelta(days=days)
+    summary = reconcile_payments(since, until, dry_run)
+    click.echo(json.dumps(summary, indent=2))
+    if summary['amount_mismatch'] or summary['not_succeeded_in_stripe'] or summary['unlabeled_pool_payments']:
+        raise SystemExit(1)
+
 @app.route('/payment-status/<payment_intent_id>')
 def payment_status(payment_intent_id):
     try:
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        state = resolve_payment_status(payment_intent_id)
         
-        # If payment succeeded and we haven't sent emails yet, send them now
-        if payment_intent.status == 'succeeded' and not payment_intent.metadata.get('emails_sent'):
-            payer_name = payment_intent.metadata.get('payer_name', 'Unknown')
-            payer_email = payment_intent.metadata.get('payer_email')
-            payment_type = payment_intent.metadata.get('payment_type', 'payment')
-            
-            # Log successful transaction
-            log_transaction(
-                payment_intent_id, payer_name, payer_email, 
-                payment_intent.amount, payment_type, 'succeeded', 
-                payment_intent.metadata
-            )
-            
-            # Send emails
-            receipt_sent = False
-            notification_sent = False
-            
-            if payer_email:
-                raffle_quantity = None
-                if payment_type == 'raffle' and 'raffle_quantity' in payment_intent.metadata:
-                    raffle_quantity = int(payment_intent.metadata.get('raffle_quantity', 0))
-                
-                receipt_sent = send_receipt_email(
-                    payer_email, payer_name, payment_intent.amount, 
-                    payment_type, payment_intent.id, raffle_quantity
-                )
-            
-            notification_sent = send_notification_email(
-                payer_name, payer_email, payment_intent.amount,
-                payment_type, payment_intent.id, payment_intent.metadata
-            )
-            
-            # Mark emails as sent to avoid duplicate sends
-            try:
-                stripe.PaymentIntent.modify(
-                    payment_intent_id,
-                    metadata={
-                        **payment_intent.metadata,
-                        'emails_sent': 'true',
-                        'receipt_sent': str(receipt_sent),
-                        'notification_sent': str(notification_sent)
-                    }
-                )
-            except Exception as e:
-                logger.error(f"Error updating payment intent metadata: {str(e)}")
+        # Long-poll fallback: hold the request until the status moves past the one the client already has
+        since = request.args.get('since')
+        wait = min(request.args.get('wait', 0, type=float), PAYMENT_LONG_POLL_MAX_SECONDS)
+        deadline = time.monotonic() + wait
+        while since and state['status'] == since and state['status'] not in FINAL_PAYMENT_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for_payment_state(payment_intent_id, since, min(remaining, payment_stream_check_interval()))
+            state = resolve_payment_status(payment_intent_id)
         
-        # Log failed/canceled transactions
-        elif payment_intent.status in ['canceled', 'payment_failed']:
-            payer_name = payment_intent.metadata.get('payer_name', 'Unknown')
-            payer_email = payment_intent.metadata.get('payer_email')
-            payment_type = payment_intent.metadata.get('payment_type', 'payment')
-            
-            log_transaction(
-                payment_intent_id, payer_name, payer_email,
-                payment_intent.amount, payment_type, payment_intent.status,
-                payment_intent.metadata
-            )
-        
-        return jsonify({
-            'status': payment_intent.status,
-            'amount': payment_intent.amount,
-            'metadata': payment_intent.metadata
-        })
+        return jsonify(state)
         
     except Exception as e:
         logger.error(f"Error checking payment status: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/payment-status/<payment_intent_id>/stream')
+def payment_status_stream(payment_intent_id):
+    """Server-Sent Events stream pushing each status change until the payment settles"""
+    def generate():
+        started = time.monotonic()
+        status = None
+        yield "retry: 2000\n\n"
+        try:
+            while time.monotonic() - started < PAYMENT_STREAM_MAX_SECONDS:
+                state = resolve_payment_status(payment_intent_id)
+                if state['status'] != status:
+                    status = state['status']
+                    yield f"data: {json.dumps(state)}\n\n"
+                    if status in FINAL_PAYMENT_STATUSES:
+                        return
+                else:
+                    yield ": keep-alive\n\n"
+                
+                # Webhooks wake this immediately; otherwise re-check when the interval runs out
+                wait_for_payment_state(payment_intent_id, status, payment_stream_check_interval())
+        except Exception as e:
+            logger.error(f"Error streaming payment status: {str(e)}")
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/stripe-webhook', methods=['POST'])
+def stripe_webhook():
+    """Receive signed Stripe events and update the local payment state store"""
+    global _last_webhook_at
+    if not STRIPE_WEBHOOK_SECRET:
+        logger.warning("STRIPE_WEBHOOK_SECRET not configured - rejecting webhook")
+        return jsonify({'error': 'Webhook endpoint not configured'}), 503
+    
+    payload = request.get_data()
+    sig_header = request.headers.get('Stripe-Signature', '')
+    
+    try:
+        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+    except ValueError as e:
+        logger.error(f"Invalid webhook payload: {str(e)}")
+        return jsonify({'error': 'Invalid payload'}), 400
+    except stripe.error.SignatureVerificationError as e:
+        logger.error(f"Invalid webhook signature: {str(e)}")
+        return jsonify({'error': 'Invalid signature'}), 400
+    _last_webhook_at = time.monotonic()
+    
+    try:
+        handle_stripe_event(event)
+    except Exception as e:
+        logger.error(f"Error handling webhook event {event['id']}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({'received': True})
+
+startup_timings['import_app'] = time.monotonic() - APP_IMPORT_STARTED
+logger.info(f"App module imported in {startup_timings['import_app']:.2f}s")
+
 if __name__ == '__main__':
     required_vars = ['STRIPE_SECRET_KEY', 'STRIPE_LOCATION_ID']
     missing_vars = [var for var in required_vars if not os.getenv(var)]
@@ -866,5 +3089,8 @@ if __name__ == '__main__':
         exit(1)
     
     logger.info("Starting POS application - Railway deployment")
+    start_email_workers()
+    preload_stripe()
     port = int(os.getenv('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    # Threaded so a slow Stripe/Gmail call or an open status stream doesn't stall other tablets
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Static Bundle Builder for the POS pages
+
+Extracts the inline <style> and <script> blocks from the page templates, minifies
+them and writes content-hashed files (plus .gz and .br variants) to static/build/.
+Bootstrap is downloaded into the same directory so pages no longer depend on the
+CDN; if it can't be downloaded the CDN links are kept.
+
+The rewritten pages go to templates/build/ and static/build/manifest.json tells the
+app to serve them. Without a build the app serves the original inline templates.
+
+Usage:
+    python3 build_static.py
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import requests
+
+try:
+    import brotli
+except ImportError:  # Installed from requirements.txt; without it only .gz variants are written
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(ROOT, 'templates')
+BUILD_TEMPLATE_DIR = os.path.join(TEMPLATE_DIR, 'build')
+BUILD_STATIC_DIR = os.path.join(ROOT, 'static', 'build')
+
+PAGES = ['index.html', 'admin_readers.html']
+
+BOOTSTRAP_CDN = 'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist'
+BOOTSTRAP_FILES = {
+    f'{BOOTSTRAP_CDN}/css/bootstrap.min.css': 'bootstrap.min.css',
+    f'{BOOTSTRAP_CDN}/js/bootstrap.bundle.min.js': 'bootstrap.bundle.min.js',
+}
+
+INLINE_BLOCK = re.compile(r'<(style|script)>(.*?)</\1>', re.S)
+
+def minify_css(css):
+    """Drop comments and the whitespace around CSS punctuation"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{}:;,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+def minify_js(js):
+    """Conservative JS minifier: strip indentation, blank lines and whole-line // comments
+
+    Anything smarter needs a real parser (strings and regexes can contain '//'), so
+    the heavy lifting is left to gzip/brotli.
+    """
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//')) + '\n'
+
+def write_asset(name, ext, content):
+    """Write a content-hashed asset with precompressed variants and return its filename"""
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    filename = f"{name}.{hashlib.sha256(data).hexdigest()[:10]}.{ext}"
+    path = os.path.join(BUILD_STATIC_DIR, filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+    return filename
+
+def vendor_bootstrap():
+    """Download Bootstrap into the build; returns {cdn_url: local filename}, empty if offline"""
+    vendored = {}
+    try:
+        for url, name in BOOTSTRAP_FILES.items():
+            response = requests.get(url, timeout=15)
+            response.raise_for_status()
+            stem, ext = name.rsplit('.', 1)
+            vendored[url] = write_asset(stem, ext, response.content)
+    except Exception as e:
+        print(f"⚠️  Could not download Bootstrap ({str(e)}) - pages keep loading it from the CDN")
+        return {}
+    return vendored
+
+def build_page(page, vendored):
+    """Move a page's inline blocks into asset files and write the rewritten template"""
+    with open(os.path.join(TEMPLATE_DIR, page)) as f:
+        html = f.read()
+    stem = page.rsplit('.', 1)[0]
+    count = {'style': 0, 'script': 0}
+
+    def extract(match):
+        tag, body = match.group(1), match.group(2)
+        if '{{' in body or '{%' in body:
+            raise ValueError(f"{page}: inline <{tag}> uses Jinja; pass values through data- attributes instead")
+        count[tag] += 1
+        name = stem if count[tag] == 1 else f"{stem}-{count[tag]}"
+        if tag == 'style':
+            return f'<link href="/static/build/{write_asset(name, "css", minify_css(body))}" rel="stylesheet">'
+        return f'<script src="/static/build/{write_asset(name, "js", minify_js(body))}"></script>'
+
+    html = INLINE_BLOCK.sub(extract, html)
+    for url, filename in vendored.items():
+        html = html.replace(url, f'/static/build/{filename}')
+
+    with open(os.path.join(BUILD_TEMPLATE_DIR, page), 'w') as f:
+        f.write(html)
+    print(f"✅ {page}: {count['style']} style and {count['script']} script block(s) extracted")
+    return f"build/{page}"
+
+def build():
+    # Start clean so stale hashed files don't pile up
+    for directory in (BUILD_STATIC_DIR, BUILD_TEMPLATE_DIR):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    vendored = vendor_bootstrap()
+    manifest = {
+        'pages': {page: build_page(page, vendored) for page in PAGES},
+        'bootstrap_cdn': not vendored,
+    }
+    with open(os.path.join(BUILD_STATIC_DIR, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"\n📦 Wrote {len(os.listdir(BUILD_STATIC_DIR)) - 1} files to static/build/"
+          f"{'' if brotli else ' (install brotli for .br variants)'}")
+
+if __name__ == "__main__":
+    print("🚀 POS Static Bundle Builder")
+    print("=" * 40)
+    build()
@@ -0,0 +1,22 @@
+"""Gunicorn settings for the POS app, shared by the Dockerfile, Procfile and Railway start script"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# One process keeps the payment state store, reader scheduler and caches shared by every tablet.
+# Threads give the concurrency: a request waiting on Stripe, Gmail or an open status stream
+# only occupies its own thread. Raise GUNICORN_THREADS for more tablets, not WEB_CONCURRENCY.
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+timeout = 60
+
+# Background threads (email outbox, ledger writer) are started inside each worker, not the master
+preload_app = False
+
+def post_worker_init(worker):
+    """Start the email outbox workers and load the Stripe SDK in the background once the app is up"""
+    from app.main import preload_stripe, start_email_workers
+    # Emails left pending by a previous process go out now, not after the next sale
+    start_email_workers()
+    preload_stripe()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Cold-Start Report for the POS app
+
+Measures what Railway restarts and scale-ups wait on:
+  1. Import time of app.main, broken down by top-level package (python -X importtime)
+  2. Time from launching gunicorn (same config as production) to the first healthy /health
+
+Run it before and after dependency or import changes to catch cold-start regressions.
+The running app also exports its own phases as pos_startup_seconds on /metrics.
+
+Usage:
+    python3 startup_report.py [--runs 3] [--top 15]
+"""
+
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+HEALTH_TIMEOUT = 60  # Seconds before a start is reported as failed
+
+def app_env(log_dir):
+    """Environment for a throwaway app process: placeholder keys and a scratch LOG_DIR"""
+    env = dict(os.environ)
+    env.setdefault('STRIPE_SECRET_KEY', 'sk_test_startup_report')
+    env['LOG_DIR'] = log_dir
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return env
+
+def measure_imports(env):
+    """Import app.main once with -X importtime; returns (total seconds, {package: self seconds})"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app.main'],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import app.main failed:\n{result.stderr[-2000:]}")
+
+    total = 0.0
+    by_package = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, _, name = match.groups()
+        package = name.split('.')[0]
+        by_package[package] = by_package.get(package, 0.0) + int(self_us) / 1e6
+        if name == 'app.main':
+            total = int(cumulative_us) / 1e6
+    return total, by_package
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def measure_first_health(env):
+    """Start gunicorn and poll /health; returns seconds until the first 200"""
+    port = free_port()
+    env = dict(env, PORT=str(port))
+    started = time.monotonic()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app.main:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.monotonic() - started < HEALTH_TIMEOUT:
+            if server.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+            try:
+                if requests.get(f'http://127.0.0.1:{port}/health', timeout=1).status_code == 200:
+                    return time.monotonic() - started
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.02)
+        raise RuntimeError(f"/health not healthy after {HEALTH_TIMEOUT}s")
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+def main():
+    parser = argparse.ArgumentParser(description='Report app import time and time to first healthy /health')
+    parser.add_argument('--runs', type=int, default=3, help='Cold starts to measure (median is reported)')
+    parser.add_argument('--top', type=int, default=15, help='Packages to list in the import breakdown')
+    args = parser.parse_args()
+
+    print("🚀 POS Cold-Start Report")
+    print("=" * 40)
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        env = app_env(log_dir)
+        imports = [measure_imports(env) for _ in range(args.runs)]
+        health = [measure_first_health(env) for _ in range(args.runs)]
+
+    print(f"\n📦 import app.main: {statistics.median(total for total, _ in imports) * 1000:.0f} ms (median of {args.runs})")
+    packages = {}
+    for _, by_package in imports:
+        for package, seconds in by_package.items():
+            packages.setdefault(package, []).append(seconds)
+    ranked = sorted(((statistics.median(times), package) for package, times in packages.items()), reverse=True)
+    for seconds, package in ranked[:args.top]:
+        print(f"   {seconds * 1000:8.1f} ms  {package}")
+
+    print(f"\n💚 gunicorn start → first healthy /health: {statistics.median(health) * 1000:.0f} ms "
+          f"(runs: {', '.join(f'{seconds * 1000:.0f}' for seconds in health)} ms)")
+
+if __name__ == "__main__":
+    main()